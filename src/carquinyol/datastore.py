@@ -23,8 +23,9 @@ import uuid
 import time
 import os
 import shutil
-import subprocess
 import tempfile
+import threading
+from multiprocessing.pool import ThreadPool
 
 import dbus
 import dbus.service
@@ -32,12 +33,16 @@ from gi.repository import GLib
 
 from sugar3 import mime
 
+from carquinyol import filestore
+from carquinyol import indexbuilder
 from carquinyol import layoutmanager
+from carquinyol import metadatastore
 from carquinyol import migration
 from carquinyol.layoutmanager import MAX_QUERY_LIMIT
 from carquinyol.metadatastore import MetadataStore
 from carquinyol.indexstore import IndexStore
 from carquinyol.filestore import FileStore
+from carquinyol.indexbuilder import IndexBuilder, complete_properties
 from carquinyol.optimizer import Optimizer
 
 # the name used by the logger
@@ -47,6 +52,17 @@ DS_SERVICE = "org.laptop.sugar.DataStore"
 DS_DBUS_INTERFACE = "org.laptop.sugar.DataStore"
 DS_OBJECT_PATH = "/org/laptop/sugar/DataStore"
 MIN_INDEX_FREE_BYTES = 1024 * 1024 * 5
+# Number of threads serving find(), find_ids() and get_properties()
+READ_THREADS = 2
+# Check whether the index should be compacted every _n_ seconds...
+COMPACTION_CHECK_INTERVAL = 15 * 60
+# ...and do it if no request came in for _n_ seconds...
+COMPACTION_IDLE_TIME = 2 * 60
+# ...and the index grew _n_ times bigger than after the last compaction
+COMPACTION_THRESHOLD = 1.5
+# Properties bigger than _n_ bytes are returned as references by
+# find_with_refs() and get_properties_with_refs()
+BLOB_THRESHOLD = 4096
 
 logger = logging.getLogger(DS_LOG_CHANNEL)
 
@@ -64,14 +80,48 @@ class DataStore(dbus.service.Object):
 
         migrated, initiated = self._open_layout()
 
-        self._metadata_store = MetadataStore()
-        self._file_store = FileStore()
+        backend = options.get('metadata_backend')
+        if backend is not None and \
+                backend != layoutmanager.get_instance().get_metadata_backend():
+            migration.migrate_metadata_backend(backend)
+
+        self._metadata_store = MetadataStore(
+            cache_entries=options.get('metadata_cache_entries',
+                                      metadatastore.CACHE_MAX_ENTRIES),
+            cache_bytes=options.get('metadata_cache_bytes',
+                                    metadatastore.CACHE_MAX_BYTES))
+        self._file_store = FileStore(
+            chunk_size=options.get('copy_chunk_size',
+                                   filestore.COPY_CHUNK_SIZE))
         self._optimizer = Optimizer(self._file_store, self._metadata_store)
-        self._index_store = IndexStore()
+        self._index_store = IndexStore(shards=options.get('index_shards', 1))
         self._index_updating = False
+        self._index_rebuilding = False
+        self._index_workers = options.get('index_workers') or \
+            indexbuilder.get_default_workers()
+        # must be forked before any thread starts
+        self._index_pool = indexbuilder.create_pool(self._index_workers)
+        self._read_pool = ThreadPool(options.get('read_threads',
+                                                 READ_THREADS))
+        self._last_activity = time.time()
+        self._index_compacting = False
+        self._compaction_report = {}
+        self._blob_threshold = options.get('blob_threshold', BLOB_THRESHOLD)
+        # D-Bus names of the clients that changed entries since the last
+        # index commit, which was the _writers_commits-th one
+        self._writers = set()
+        self._writers_commits = 0
+        GLib.timeout_add_seconds(COMPACTION_CHECK_INTERVAL,
+                                 self.__compaction_check_cb)
 
         root_path = layoutmanager.get_instance().get_root_path()
         self._cleanflag = os.path.join(root_path, 'ds_clean')
+        self._dirty_log_path = os.path.join(root_path, 'ds_dirty')
+        self._dirty_log = None
+        # set when the journal could not be written, until the datastore
+        # is clean again
+        self._dirty_log_broken = False
+        self._dirty_uids = []
 
         if initiated:
             logging.debug('Initiate datastore')
@@ -86,6 +136,7 @@ class DataStore(dbus.service.Object):
             return
 
         rebuild = False
+        dirty_uids = []
         stat = os.statvfs(root_path)
         da = stat.f_bavail * stat.f_bsize
 
@@ -94,7 +145,9 @@ class DataStore(dbus.service.Object):
             rebuild = True
         elif not os.path.exists(self._cleanflag):
             logging.warn('DS state is not clean')
-            rebuild = True
+            dirty_uids = self._get_dirty_uids()
+            if dirty_uids is None:
+                rebuild = True
         elif da < MIN_INDEX_FREE_BYTES:
             logging.warn('Disk space tight for index')
             rebuild = True
@@ -106,6 +159,9 @@ class DataStore(dbus.service.Object):
             # fast path
             try:
                 self._index_store.open_index()
+                uids = self._index_store.get_pending_intents()
+                uids += [uid for uid in dirty_uids if uid not in uids]
+                self._reconcile_entries(uids)
             except:
                 logging.exception('Failed to open index')
                 # try...
@@ -114,20 +170,110 @@ class DataStore(dbus.service.Object):
         self._mark_clean()
         return
 
-    def _mark_clean(self):
+    def _mark_clean(self, uid=None):
+        """Mark the datastore clean once no operation is in flight."""
+        self._mark_clean_many([uid])
+
+    def _mark_clean_many(self, uids):
+        for uid in uids:
+            if uid in self._dirty_uids:
+                self._dirty_uids.remove(uid)
+        if self._dirty_uids:
+            return
+
         try:
             f = open(self._cleanflag, 'w')
             os.fsync(f.fileno())
             f.close()
         except:
             logging.exception("Could not mark the datastore clean")
+            return
+
+        if self._dirty_log is not None:
+            self._dirty_log.close()
+            self._dirty_log = None
+        self._dirty_log_broken = False
+        try:
+            os.remove(self._dirty_log_path)
+        except OSError:
+            pass
+
+    def _mark_dirty(self, uid):
+        """Record that uid is being changed before touching it on disk.
+
+        The uid is appended to the ds_dirty journal so that, should we
+        crash before _mark_clean(), only the entries it lists need to be
+        reconciled at startup.
+        """
+        self._mark_dirty_many([uid])
+
+    def _mark_dirty_many(self, uids):
+        self._last_activity = time.time()
+        self._dirty_uids.extend(uids)
+        # an incomplete journal would hide entries from the reconciliation
+        # at startup, so none is kept until the next clean mark
+        if not self._dirty_log_broken:
+            self._log_dirty(uids)
 
-    def _mark_dirty(self):
         try:
             os.remove(self._cleanflag)
         except:
             pass
 
+    def _log_dirty(self, uids):
+        try:
+            if self._dirty_log is None:
+                self._dirty_log = open(self._dirty_log_path, 'a')
+            for uid in uids:
+                self._dirty_log.write(uid + '\n')
+            self._dirty_log.flush()
+            os.fsync(self._dirty_log.fileno())
+        except (IOError, OSError):
+            logging.exception('Could not log dirty entries %r', uids)
+            # without a complete journal only a full rebuild is safe
+            self._dirty_log_broken = True
+            if self._dirty_log is not None:
+                try:
+                    self._dirty_log.close()
+                except (IOError, OSError):
+                    pass
+                self._dirty_log = None
+            try:
+                os.remove(self._dirty_log_path)
+            except OSError:
+                pass
+
+    def _release_failed(self, uids):
+        """Mark entries an operation failed on clean again.
+
+        Their on-disk state is reconciled with the index first. Should
+        that fail as well, the whole index gets rebuilt.
+        """
+        try:
+            self._reconcile_entries(uids)
+        except Exception:
+            logging.exception('Could not reconcile %r, rebuilding index',
+                              uids)
+            self._rebuild_index()
+        self._mark_clean_many(uids)
+
+    def _get_dirty_uids(self):
+        """Return the uids listed in the ds_dirty journal.
+
+        Returns None if there is no journal, i.e. the datastore was left
+        dirty by a version that did not keep one.
+        """
+        if not os.path.exists(self._dirty_log_path):
+            return None
+
+        uids = []
+        for line in open(self._dirty_log_path, 'r'):
+            uid = line.strip()
+            # skip a torn write at the end of the journal
+            if len(uid) == 36 and uid not in uids:
+                uids.append(uid)
+        return uids
+
     def _open_layout(self):
         """Open layout manager, check version of data store on disk and
         migrate if necessary.
@@ -149,141 +295,199 @@ class DataStore(dbus.service.Object):
         if old_version == 0:
             migration.migrate_from_0()
 
+        if old_version < 7 and not migration.migrate_to_7():
+            # the entries left over are retried at the next start
+            layout_manager.set_version(6)
+            return True, False
+
         layout_manager.set_version(layoutmanager.CURRENT_LAYOUT_VERSION)
         return True, False
 
-    def _rebuild_index(self):
-        """Remove and recreate index."""
-        self._index_store.close_index()
-        self._index_store.remove_index()
+    def _reconcile_entries(self, uids):
+        """Bring the index in line with the on-disk state of some entries.
 
-        # rebuild the index in tmpfs to better handle ENOSPC
-        temp_index_path = tempfile.mkdtemp(prefix='sugar-datastore-index-')
-        logger.debug('Rebuilding index in %s' % temp_index_path)
-        self._index_store.open_index(temp_path=temp_index_path)
-        self._update_index()
-        self._index_store.close_index()
+        Used at startup for the entries that were being changed when the
+        service went away, instead of rebuilding the whole index.
+        """
+        if not uids:
+            return
+
+        logging.warn('Reconciling %d entries with the index', len(uids))
+        layout_manager = layoutmanager.get_instance()
+        for uid in uids:
+            if self._metadata_store.contains(uid):
+                try:
+                    props = self._metadata_store.retrieve(uid)
+                    if complete_properties(uid, props):
+                        self._metadata_store.store(uid, props)
+                    self._index_store.store(uid, props)
+                    continue
+                except Exception:
+                    logging.exception('Error processing %r', uid)
 
-        on_disk = False
+            # half-created, half-deleted or corrupt entry
+            entry_path = layout_manager.get_entry_path(uid)
+            if os.path.isdir(layout_manager.get_metadata_path(uid)):
+                logging.warn('Entry %r is not migrated yet, leaving it '
+                             'alone', uid)
+            elif os.path.exists(entry_path):
+                logging.warn('Removing incomplete entry %r', uid)
+                shutil.rmtree(entry_path)
+            if self._index_store.contains(uid):
+                self._index_store.delete(uid)
+        self._index_store.flush()
 
-        # can we fit the index on disk? get disk usage in bytes...
-        index_du = subprocess.check_output(['/usr/bin/du', '-bs',
-                                            temp_index_path])
-        index_du = int(index_du.split('\t')[0])
-        # disk available, in bytes
-        stat = os.statvfs(temp_index_path)
-        da = stat.f_bavail * stat.f_bsize
-        if da > (index_du * 1.2) and da > MIN_INDEX_FREE_BYTES:
-            # 1.2 due to 20% room for growth
-            logger.debug('Attempting to move tempfs index to disk')
-            # move to internal disk
+    def _rebuild_index(self):
+        """Build a new index next to the live one and swap them when done.
+
+        The live index, if it can be opened at all, keeps answering queries
+        during the rebuild. Otherwise queries fall back to _find_all().
+        """
+        if self._index_rebuilding:
+            return
+        self._index_rebuilding = True
+
+        if not self._index_store.is_open():
             try:
-                index_path = layoutmanager.get_instance().get_index_path()
-                if os.path.exists(index_path):
-                    shutil.rmtree(index_path)
-                shutil.copytree(temp_index_path, index_path)
-                shutil.rmtree(temp_index_path)
-                on_disk = True
+                self._index_store.open_index()
             except Exception:
-                logger.exception('Error copying tempfs index to disk,'
-                                 'revert to using tempfs index.')
-        else:
-            logger.warn("Not enough disk space, using tempfs index")
+                logging.exception('Live index unusable during rebuild')
+                self._index_updating = True
 
-        if on_disk:
-            self._index_store.open_index()
-        else:
-            self._index_store.open_index(temp_path=temp_index_path)
+        layout_manager = layoutmanager.get_instance()
+        shadow_path = layout_manager.get_shadow_index_path()
+        index_size = 0
+        if self._index_store.is_open():
+            index_size = self._index_store.get_index_size()
+        stat = os.statvfs(layout_manager.get_root_path())
+        da = stat.f_bavail * stat.f_bsize
+        # 1.2 due to 20% room for growth
+        if da < (index_size * 1.2) or da < MIN_INDEX_FREE_BYTES:
+            # rebuild the index in tmpfs to better handle ENOSPC
+            logger.warn('Not enough disk space, using tempfs index')
+            shadow_path = tempfile.mkdtemp(prefix='sugar-datastore-index-')
+
+        logger.debug('Rebuilding index in %s' % shadow_path)
+        self._index_store.start_shadow(shadow_path)
+        self._update_index()
 
     def _update_index(self):
         """Find entries that are not yet in the index and add them."""
         uids = layoutmanager.get_instance().find_all()
         logging.debug('Going to update the index with object_ids %r',
                       uids)
-        self._index_updating = True
-        GLib.idle_add(lambda: self.__update_index_cb(uids),
-                         priority=GLib.PRIORITY_LOW)
+        builder = IndexBuilder(self._index_store, self._metadata_store, uids,
+                               self._index_pool, self._index_workers,
+                               progress_cb=self.__update_index_progress_cb,
+                               completion_cb=self.__update_index_done_cb)
+        builder.start()
 
-    def __update_index_cb(self, uids):
-        if uids:
-            uid = uids.pop()
+    def __update_index_progress_cb(self, done, total):
+        logging.info('Updating index: %d of %d entries done', done, total)
 
-            logging.debug('Updating entry %r in index. %d to go.', uid,
-                          len(uids))
+    def __update_index_done_cb(self):
+        self._index_store.finish_shadow()
+        self._index_updating = False
+        self._index_rebuilding = False
+        logging.debug('Finished updating index.')
+
+    def __compaction_check_cb(self):
+        if self._index_rebuilding or self._index_compacting or \
+                not self._index_store.is_open() or \
+                self._index_store.is_temporary() or \
+                time.time() - self._last_activity < COMPACTION_IDLE_TIME:
+            return True
 
-            if not self._index_store.contains(uid):
-                try:
-                    update_metadata = False
-                    props = self._metadata_store.retrieve(uid)
-                    if 'filesize' not in props:
-                        path = self._file_store.get_file_path(uid)
-                        if os.path.exists(path):
-                            props['filesize'] = os.stat(path).st_size
-                            update_metadata = True
-                    if 'timestamp' not in props:
-                        props['timestamp'] = str(int(time.time()))
-                        update_metadata = True
-                    if 'creation_time' not in props:
-                        if 'ctime' in props:
-                            try:
-                                props['creation_time'] = time.mktime(
-                                    time.strptime(
-                                        props['ctime'],
-                                        migration.DATE_FORMAT))
-                            except (TypeError, ValueError):
-                                pass
-                        if 'creation_time' not in props:
-                            props['creation_time'] = props['timestamp']
-                        update_metadata = True
-                    if update_metadata:
-                        self._metadata_store.store(uid, props)
-                    self._index_store.store(uid, props)
-                except Exception:
-                    logging.exception('Error processing %r', uid)
-                    logging.warn('Will attempt to delete corrupt entry %r',
-                                 uid)
-                    try:
-                        # self.delete(uid) only works on well-formed
-                        # entries :-/
-                        entry_path = \
-                            layoutmanager.get_instance().get_entry_path(uid)
-                        shutil.rmtree(entry_path)
-                    except Exception:
-                        logging.exception('Error deleting corrupt entry %r',
-                                          uid)
+        if self._index_store.is_empty():
+            # there is nothing to compact, and as an empty index never
+            # gets a compacted size recorded it would be compacted again
+            # at every check
+            return True
 
-        if not uids:
-            self._index_store.flush()
-            self._index_updating = False
-            logging.debug('Finished updating index.')
+        fragmentation = self._index_store.get_fragmentation()
+        if fragmentation is None or fragmentation > COMPACTION_THRESHOLD:
+            logging.debug('Index fragmentation %r, compacting', fragmentation)
+            self._compact_index()
+        return True
+
+    def _compact_index(self):
+        """Compact the index into a side directory in a thread, then swap
+        it in if the index did not change in the meantime."""
+        self._index_store.commit_pending()
+        self._index_compacting = True
+        before = (self._index_store.get_index_size(),
+                  self._index_store.measure_query_latency())
+        revision = self._index_store.revision
+
+        path = layoutmanager.get_instance().get_compacted_index_path()
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+        def compact():
+            try:
+                self._index_store.compact_to(path)
+                exc = None
+            except Exception, e:
+                logging.exception('Error compacting the index')
+                exc = e
+            GLib.idle_add(self.__compaction_done_cb, path, revision, before,
+                          exc)
+
+        thread = threading.Thread(target=compact)
+        thread.daemon = True
+        thread.start()
+
+    def __compaction_done_cb(self, path, revision, before, exc):
+        self._index_compacting = False
+        if exc is not None or self._index_rebuilding or \
+                self._index_store.revision != revision:
+            if exc is None:
+                logging.debug('Index changed while compacting, discarding')
+            shutil.rmtree(path, ignore_errors=True)
             return False
-        else:
-            return True
+
+        self._index_store.replace_index(path)
+        after = (self._index_store.get_index_size(),
+                 self._index_store.measure_query_latency())
+        logger.info('Compacted index from %d to %d bytes, query latency '
+                    'from %.1fms to %.1fms', before[0], after[0],
+                    before[1] * 1000, after[1] * 1000)
+        self._compaction_report = {
+            'compaction_time': int(time.time()),
+            'compaction_size_before': before[0],
+            'compaction_size_after': after[0],
+            'compaction_latency_before': before[1],
+            'compaction_latency_after': after[1],
+        }
+        return False
 
     def _create_completion_cb(self, async_cb, async_err_cb, uid, exc=None):
         logger.debug('_create_completion_cb(%r, %r, %r, %r)', async_cb,
                      async_err_cb, uid, exc)
         if exc is not None:
+            self._release_failed([uid])
             async_err_cb(exc)
             return
 
         self.Created(uid)
         self._optimizer.optimize(uid)
         logger.debug('created %s', uid)
-        self._mark_clean()
+        self._mark_clean(uid)
         async_cb(uid)
 
     @dbus.service.method(DS_DBUS_INTERFACE,
                          in_signature='a{sv}sb',
                          out_signature='s',
+                         sender_keyword='sender',
                          async_callbacks=('async_cb', 'async_err_cb'),
                          byte_arrays=True)
     def create(self, props, file_path, transfer_ownership,
-               async_cb, async_err_cb):
+               async_cb, async_err_cb, sender=None):
         uid = str(uuid.uuid4())
         logging.debug('datastore.create %r', uid)
 
-        self._mark_dirty()
+        self._note_writer(sender)
+        self._mark_dirty(uid)
 
         if not props.get('timestamp', ''):
             props['timestamp'] = int(time.time())
@@ -321,25 +525,28 @@ class DataStore(dbus.service.Object):
         logger.debug('_update_completion_cb() called with %r / %r, exc %r',
                      async_cb, async_err_cb, exc)
         if exc is not None:
+            self._release_failed([uid])
             async_err_cb(exc)
             return
 
         self.Updated(uid)
         self._optimizer.optimize(uid)
         logger.debug('updated %s', uid)
-        self._mark_clean()
+        self._mark_clean(uid)
         async_cb()
 
     @dbus.service.method(DS_DBUS_INTERFACE,
                          in_signature='sa{sv}sb',
                          out_signature='',
+                         sender_keyword='sender',
                          async_callbacks=('async_cb', 'async_err_cb'),
                          byte_arrays=True)
     def update(self, uid, props, file_path, transfer_ownership,
-               async_cb, async_err_cb):
+               async_cb, async_err_cb, sender=None):
         logging.debug('datastore.update %r', uid)
 
-        self._mark_dirty()
+        self._note_writer(sender)
+        self._mark_dirty(uid)
 
         if not props.get('timestamp', ''):
             props['timestamp'] = int(time.time())
@@ -380,40 +587,224 @@ class DataStore(dbus.service.Object):
     def Updated(self, uid):
         pass
 
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='sa{sv}as',
+                         out_signature='',
+                         sender_keyword='sender',
+                         byte_arrays=True)
+    def set_properties(self, uid, changed, removed, sender=None):
+        """Set the properties in changed and remove those listed in removed,
+        leaving the other properties and the data file alone.
+
+        Unlike update(), the timestamp is not bumped unless it is part of
+        changed, and the entry is only reindexed if an indexed property
+        actually changed.
+        """
+        logging.debug('datastore.set_properties %r', uid)
+        self._note_writer(sender)
+        self._mark_dirty(uid)
+        try:
+            metadata, modified = self._metadata_store.update(uid, changed,
+                                                             removed)
+            if self._index_store.affects_index(modified):
+                self._index_store.store(uid, metadata)
+        except:
+            logger.exception('Exception setting properties')
+            self._release_failed([uid])
+            raise
+
+        self.Updated(uid)
+        self._mark_clean(uid)
+
+    def _note_writer(self, sender):
+        """Remember that sender changed entries since the last commit."""
+        commits = self._index_store.get_commit_count()
+        if commits != self._writers_commits:
+            self._writers.clear()
+            self._writers_commits = commits
+        if sender is not None:
+            self._writers.add(sender)
+
+    def _read_async(self, function, args, reply_cb, async_err_cb,
+                    sender=None):
+        """Run function(*args) on the read thread pool.
+
+        The outcome is passed back to the main loop, to reply_cb or, if
+        function raised, to async_err_cb.
+
+        Read threads see the last commit of the index. Changes are
+        committed in groups (see IndexStore._flush()), so they show up in
+        results of other clients with a delay of a few seconds at most.
+        Only a client that changed entries since the last commit gets them
+        committed before its query runs, so that it finds its own changes.
+        """
+        self._last_activity = time.time()
+        self._note_writer(None)
+        if sender in self._writers:
+            self._index_store.commit_pending()
+
+        def run():
+            try:
+                return None, function(*args)
+            except Exception, e:
+                logging.debug('Read failed: %r', e)
+                return e, None
+
+        def done_cb(outcome):
+            GLib.idle_add(self.__read_done_cb, outcome, reply_cb,
+                          async_err_cb)
+
+        self._read_pool.apply_async(run, callback=done_cb)
+
+    def __read_done_cb(self, outcome, reply_cb, async_err_cb):
+        exc, result = outcome
+        if exc is not None:
+            async_err_cb(exc)
+        else:
+            try:
+                reply_cb(result)
+            except Exception, e:
+                logging.exception('Error replying to a read request')
+                async_err_cb(e)
+        return False
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='a{sv}as',
+                         out_signature='aa{sv}u',
+                         sender_keyword='sender',
+                         async_callbacks=('async_cb', 'async_err_cb'))
+    def find(self, query, properties, async_cb, async_err_cb,
+             sender=None):
+        self._read_async(self._find, (query, properties),
+                         lambda result: self.__find_reply_cb(
+                             query, properties, result, async_cb, False),
+                         async_err_cb, sender)
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='a{sv}as',
+                         out_signature='aa{sv}us',
+                         sender_keyword='sender',
+                         async_callbacks=('async_cb', 'async_err_cb'))
+    def find_page(self, query, properties, async_cb, async_err_cb,
+                  sender=None):
+        """Like find(), but also return a cursor for the next page.
+
+        Passing the cursor back as the 'cursor' key of the query, instead
+        of an offset, makes every page cost the same regardless of how
+        deep into the results it is.
+        """
+        self._read_async(self._find, (query, properties),
+                         lambda result: self.__find_reply_cb(
+                             query, properties, result, async_cb, True),
+                         async_err_cb, sender)
+
     @dbus.service.method(DS_DBUS_INTERFACE,
                          in_signature='a{sv}as',
-                         out_signature='aa{sv}u')
-    def find(self, query, properties):
+                         out_signature='aa{sv}u',
+                         sender_keyword='sender',
+                         async_callbacks=('async_cb', 'async_err_cb'))
+    def find_with_refs(self, query, properties, async_cb, async_err_cb,
+                       sender=None):
+        """Like find(), but properties bigger than the blob threshold are
+        replaced by (uid, name, size) references.
+
+        The client reads the ones it needs with get_blob(), so the images
+        and other large values do not travel through the bus.
+        """
+        if properties and 'uid' not in properties:
+            properties = list(properties) + ['uid']
+        self._read_async(self._find, (query, properties),
+                         lambda result: self.__find_reply_cb(
+                             query, properties, result, async_cb, False,
+                             True),
+                         async_err_cb, sender)
+
+    def __find_reply_cb(self, query, properties, result, async_cb,
+                        with_cursor, blob_refs=False):
+        if result is None:
+            self._rebuild_index()
+            entries, count, cursor = self._find_all(query, properties)
+        else:
+            entries, count, cursor, vanished = result
+            if vanished:
+                self._check_vanished(vanished)
+        if blob_refs:
+            for metadata in entries:
+                self._replace_blobs(metadata['uid'], metadata)
+        if with_cursor:
+            async_cb(entries, count, cursor)
+        else:
+            async_cb(entries, count)
+
+    def _check_vanished(self, uids):
+        """Rebuild the index if it lists entries that do not exist.
+
+        Entries deleted while a read thread was querying the index vanish
+        from it as well, so only those left over point to a broken index.
+        """
+        if self._index_rebuilding or not self._index_store.is_open():
+            return
+        self._index_store.commit_pending()
+        missing = [uid for uid in uids if self._index_store.contains(uid)
+                   and not self._metadata_store.contains(uid)]
+        if missing:
+            logging.warning('Inconsistency detected for %r, rebuilding '
+                            'index', missing)
+            self._rebuild_index()
+
+    def _find(self, query, properties):
+        """Query the index and read the metadata of the results.
+
+        Runs in a read thread. Returns None if the index turned out to be
+        broken, as only the main loop may rebuild it. Else the last item of
+        the result lists the entries that vanished since the index was
+        queried, left for the main loop to check.
+        """
         logging.debug('datastore.find %r', query)
         t = time.time()
 
-        if not self._index_updating:
-            try:
-                uids, count = self._index_store.find(query)
-            except Exception:
-                logging.exception('Failed to query index, will rebuild')
-                self._rebuild_index()
-
         if self._index_updating:
             logging.warning('Index updating, returning all entries')
-            return self._find_all(query, properties)
+            return self._find_all(query, properties) + ([], )
+
+        try:
+            if self._index_store.covers(properties):
+                hits, count, cursor = self._index_store.find_entries(
+                    dict(query), properties)
+            else:
+                uids, count, cursor = self._index_store.find(dict(query))
+                hits = [(uid, None) for uid in uids]
+        except ValueError:
+            raise
+        except Exception:
+            logging.exception('Failed to query index, will rebuild')
+            return None
+
+        # read the metadata of the whole page in one go
+        retrieved = iter(self._metadata_store.retrieve_many(
+            [uid for uid, metadata in hits if metadata is None], properties))
 
         entries = []
-        for uid in uids:
-            entry_path = layoutmanager.get_instance().get_entry_path(uid)
-            if not os.path.exists(entry_path):
-                logging.warning(
-                    'Inconsistency detected, returning all entries')
-                self._rebuild_index()
-                return self._find_all(query, properties)
+        vanished = []
+        for uid, metadata in hits:
+            if metadata is not None:
+                # answered from the index, no need to touch the entry
+                self._fill_covered_props(metadata, uid, properties)
+                entries.append(metadata)
+                continue
+
+            metadata = retrieved.next()
+            if metadata is None:
+                # most likely deleted meanwhile
+                vanished.append(uid)
+                continue
 
-            metadata = self._metadata_store.retrieve(uid, properties)
             self._fill_internal_props(metadata, uid, properties)
             entries.append(metadata)
 
         logger.debug('find(): %r', time.time() - t)
 
-        return entries, count
+        return entries, max(0, count - len(vanished)), cursor, vanished
 
     def _find_all(self, query, properties):
         uids = layoutmanager.get_instance().find_all()
@@ -424,12 +815,16 @@ class DataStore(dbus.service.Object):
         uids = uids[offset:offset + limit]
 
         entries = []
-        for uid in uids:
-            metadata = self._metadata_store.retrieve(uid, properties)
+        for uid, metadata in zip(uids, self._metadata_store.retrieve_many(
+                uids, properties)):
+            if metadata is None:
+                # deleted meanwhile
+                continue
             self._fill_internal_props(metadata, uid, properties)
             entries.append(metadata)
 
-        return entries, count
+        # no cursor, paging through unindexed entries requires offsets
+        return entries, count, ''
 
     def _fill_internal_props(self, metadata, uid, names=None):
         """Fill in internal / computed properties in metadata
@@ -448,17 +843,88 @@ class DataStore(dbus.service.Object):
             else:
                 metadata['filesize'] = '0'
 
+    def _fill_covered_props(self, metadata, uid, names):
+        """Make metadata read from the index look like metadata read from
+        the entry."""
+        # documents indexed before filesize was taken out of
+        # _COVERED_PROPERTIES still hold it; like for entries, the size is
+        # the one of the data file now
+        metadata.pop('filesize', None)
+        for name, value in metadata.items():
+            if value:
+                # that's what metadatareader returns
+                metadata[name] = dbus.ByteArray(value)
+
+        if 'uid' in names:
+            metadata['uid'] = uid
+
+        if 'filesize' in names:
+            self._fill_internal_props(metadata, uid, ['filesize'])
+
     @dbus.service.method(DS_DBUS_INTERFACE,
                          in_signature='a{sv}',
-                         out_signature='as')
-    def find_ids(self, query):
-        if not self._index_updating:
-            try:
-                return self._index_store.find(query)[0]
-            except Exception:
-                logging.error('Failed to query index, will rebuild')
-                self._rebuild_index()
-        return []
+                         out_signature='as',
+                         sender_keyword='sender',
+                         async_callbacks=('async_cb', 'async_err_cb'))
+    def find_ids(self, query, async_cb, async_err_cb, sender=None):
+        if self._index_updating:
+            async_cb([])
+            return
+        self._read_async(self._find_ids, (query, ),
+                         lambda uids: self.__find_ids_reply_cb(uids,
+                                                               async_cb),
+                         async_err_cb, sender)
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='a{sv}b',
+                         out_signature='u',
+                         sender_keyword='sender',
+                         async_callbacks=('async_cb', 'async_err_cb'))
+    def find_count(self, query, exact, async_cb, async_err_cb,
+                   sender=None):
+        """Return the number of entries matching query.
+
+        If exact is False, an estimate is returned, which is cheaper for
+        large result sets.
+        """
+        if self._index_updating:
+            async_cb(len(layoutmanager.get_instance().find_all()))
+            return
+        self._read_async(self._find_count, (query, exact),
+                         lambda count: self.__find_count_reply_cb(
+                             count, async_cb),
+                         async_err_cb, sender)
+
+    def _find_count(self, query, exact):
+        try:
+            return self._index_store.count(query, exact)
+        except ValueError:
+            raise
+        except Exception:
+            logging.exception('Failed to query index, will rebuild')
+            return None
+
+    def __find_count_reply_cb(self, count, async_cb):
+        if count is None:
+            self._rebuild_index()
+            count = len(layoutmanager.get_instance().find_all())
+        async_cb(count)
+
+    def _find_ids(self, query):
+        try:
+            return self._index_store.find(dict(query))[0]
+        except ValueError:
+            # e.g. a malformed cursor, not a broken index
+            raise
+        except Exception:
+            logging.error('Failed to query index, will rebuild')
+            return None
+
+    def __find_ids_reply_cb(self, uids, async_cb):
+        if uids is None:
+            self._rebuild_index()
+            uids = []
+        async_cb(uids)
 
     @dbus.service.method(DS_DBUS_INTERFACE,
                          in_signature='s',
@@ -478,59 +944,283 @@ class DataStore(dbus.service.Object):
 
     @dbus.service.method(DS_DBUS_INTERFACE,
                          in_signature='s',
-                         out_signature='a{sv}')
-    def get_properties(self, uid):
+                         out_signature='a{sv}',
+                         async_callbacks=('async_cb', 'async_err_cb'))
+    def get_properties(self, uid, async_cb, async_err_cb):
         logging.debug('datastore.get_properties %r', uid)
+        self._read_async(self._get_properties, (uid, ), async_cb,
+                         async_err_cb)
+
+    def _get_properties(self, uid):
         metadata = self._metadata_store.retrieve(uid)
         self._fill_internal_props(metadata, uid)
         return metadata
 
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='s',
+                         out_signature='a{sv}',
+                         async_callbacks=('async_cb', 'async_err_cb'))
+    def get_properties_with_refs(self, uid, async_cb, async_err_cb):
+        """Like get_properties(), but properties bigger than the blob
+        threshold are replaced by references (see find_with_refs())."""
+        logging.debug('datastore.get_properties_with_refs %r', uid)
+        self._read_async(self._get_properties, (uid, ),
+                         lambda metadata: async_cb(
+                             self._replace_blobs(uid, metadata)),
+                         async_err_cb)
+
+    def _replace_blobs(self, uid, metadata):
+        for name, value in metadata.items():
+            if isinstance(value, basestring) and \
+                    len(value) > self._blob_threshold:
+                metadata[name] = dbus.Struct(
+                    (uid, name, dbus.UInt32(len(value))), signature='ssu')
+        return metadata
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='ss',
+                         out_signature='h')
+    def get_blob(self, uid, name):
+        """Return a read-only file descriptor holding a property value.
+
+        The client can read() or mmap() it; its contents do not go through
+        the bus.
+        """
+        logging.debug('datastore.get_blob %r %r', uid, name)
+        blob = self._metadata_store.open_property(uid, name)
+        if blob is None:
+            raise ValueError('Entry %r has no property %r' % (uid, name))
+        try:
+            # UnixFd duplicates the descriptor
+            return dbus.types.UnixFd(blob)
+        finally:
+            blob.close()
+
     @dbus.service.method(DS_DBUS_INTERFACE,
                          in_signature='sa{sv}',
                          out_signature='as')
     def get_uniquevaluesfor(self, propertyname, query=None):
-        if propertyname != 'activity':
-            raise ValueError('Only ''activity'' is a supported property name')
-        if query:
-            raise ValueError('The query parameter is not supported')
         if not self._index_updating:
-            return self._index_store.get_activities()
+            facets = self._index_store.get_facets([propertyname], query)
+            return facets[propertyname].keys()
         else:
             logging.warning('Index updating, returning an empty list')
             return []
 
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='asa{sv}',
+                         out_signature='a{sa{su}}')
+    def get_facets(self, properties, query):
+        """Return the number of entries matching query per value of each
+        of the given properties."""
+        if not self._index_updating:
+            return self._index_store.get_facets(properties, query)
+        else:
+            logging.warning('Index updating, returning no facets')
+            return {}
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='ssu',
+                         out_signature='a(su)',
+                         sender_keyword='sender',
+                         async_callbacks=('async_cb', 'async_err_cb'))
+    def suggest(self, prefix, propertyname, limit, async_cb, async_err_cb,
+                sender=None):
+        """Return up to limit (term, count) pairs of indexed terms starting
+        with prefix, the most frequent first.
+
+        An empty propertyname suggests words of the full text index.
+        """
+        if self._index_updating:
+            logging.warning('Index updating, returning no suggestions')
+            async_cb([])
+            return
+        self._read_async(self._index_store.suggest,
+                         (prefix, propertyname, limit), async_cb,
+                         async_err_cb, sender)
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='a{sv}ss',
+                         out_signature='a{xu}',
+                         sender_keyword='sender',
+                         async_callbacks=('async_cb', 'async_err_cb'))
+    def get_timeline(self, query, propertyname, bucket, async_cb,
+                     async_err_cb, sender=None):
+        """Return the number of entries matching query per hour, day, week
+        or month of the given time property.
+
+        The result maps the start of each non-empty interval (seconds since
+        the epoch) to the number of entries in it.
+        """
+        if self._index_updating:
+            logging.warning('Index updating, returning an empty timeline')
+            async_cb({})
+            return
+        self._read_async(self._index_store.get_timeline,
+                         (query, propertyname, bucket), async_cb,
+                         async_err_cb, sender)
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='',
+                         out_signature='a(sttt)')
+    def get_index_report(self):
+        """Return (property, entries, bytes indexed, bytes left out) for
+        each indexed property, the largest first."""
+        return self._index_store.get_indexed_sizes()
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='',
+                         out_signature='a{sv}')
+    def get_statistics(self):
+        """Return counters that help assessing the datastore performance."""
+        statistics = {}
+        for key, value in self._index_store.get_cache_stats().items():
+            statistics['query_cache_' + key] = value
+        for key, value in self._metadata_store.get_cache_stats().items():
+            statistics['metadata_cache_' + key] = value
+        for key, value in self._metadata_store.get_syscall_counts().items():
+            statistics['metadata_syscalls_' + key] = value
+        for key, value in self._file_store.get_copy_stats().items():
+            statistics['copy_' + key] = value
+        statistics.update(self._compaction_report)
+        return statistics
+
     @dbus.service.method(DS_DBUS_INTERFACE,
                          in_signature='s',
-                         out_signature='')
-    def delete(self, uid):
-        self._mark_dirty()
+                         out_signature='',
+                         sender_keyword='sender')
+    def delete(self, uid, sender=None):
+        self._note_writer(sender)
+        self._mark_dirty(uid)
         try:
-            entry_path = layoutmanager.get_instance().get_entry_path(uid)
             self._optimizer.remove(uid)
             self._index_store.delete(uid)
-            self._file_store.delete(uid)
-            self._metadata_store.delete(uid)
-            # remove the dirtree
-            shutil.rmtree(entry_path)
-            try:
-                # will remove the hashed dir if nothing else is there
-                os.removedirs(os.path.dirname(entry_path))
-            except:
-                pass
+            self._delete_entry(uid)
         except:
             logger.exception('Exception deleting entry')
+            self._release_failed([uid])
             raise
 
         self.Deleted(uid)
         logger.debug('deleted %s', uid)
-        self._mark_clean()
+        self._mark_clean(uid)
+
+    def _delete_entry(self, uid):
+        entry_path = layoutmanager.get_instance().get_entry_path(uid)
+        self._file_store.delete(uid)
+        self._metadata_store.delete(uid)
+        # remove the dirtree
+        shutil.rmtree(entry_path)
+        try:
+            # will remove the hashed dir if nothing else is there
+            os.removedirs(os.path.dirname(entry_path))
+        except:
+            pass
 
     @dbus.service.signal(DS_DBUS_INTERFACE, signature="s")
     def Deleted(self, uid):
         pass
 
+    def _resolve_query(self, query):
+        """Return the uids of all entries matching query.
+
+        Unlike find(), no limit applies unless the query sets one.
+        """
+        if self._index_updating:
+            raise RuntimeError('Index updating, cannot resolve query')
+
+        # results cached by read threads only cover committed changes
+        self._index_store.commit_pending()
+        query = dict(query)
+        for key in ['offset', 'cursor']:
+            query.pop(key, None)
+        if 'limit' not in query:
+            query['limit'] = self._index_store.count(query)
+        return self._index_store.find(query)[0]
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='a{sv}',
+                         out_signature='as',
+                         sender_keyword='sender')
+    def delete_by_query(self, query, sender=None):
+        """Delete all entries matching query and return their uids.
+
+        The entries are removed from the index in a single commit and
+        BulkDeleted is emitted once instead of Deleted for each entry.
+        """
+        uids = self._resolve_query(query)
+        logging.debug('datastore.delete_by_query %r: %d entries', query,
+                      len(uids))
+        if not uids:
+            return []
+
+        self._note_writer(sender)
+        self._mark_dirty_many(uids)
+        try:
+            for uid in uids:
+                self._optimizer.remove(uid)
+            self._index_store.delete_entries(uids)
+            for uid in uids:
+                self._delete_entry(uid)
+        except:
+            logger.exception('Exception deleting entries')
+            self._release_failed(uids)
+            raise
+
+        self.BulkDeleted(uids)
+        self._mark_clean_many(uids)
+        return uids
+
+    @dbus.service.signal(DS_DBUS_INTERFACE, signature="as")
+    def BulkDeleted(self, uids):
+        pass
+
+    @dbus.service.method(DS_DBUS_INTERFACE,
+                         in_signature='a{sv}a{sv}',
+                         out_signature='as',
+                         sender_keyword='sender',
+                         byte_arrays=True)
+    def set_properties_by_query(self, query, props, sender=None):
+        """Set props on all entries matching query and return their uids.
+
+        Other properties and the data files are left alone. The index is
+        updated in a single commit and BulkUpdated is emitted once instead
+        of Updated for each entry.
+        """
+        uids = self._resolve_query(query)
+        logging.debug('datastore.set_properties_by_query %r: %d entries',
+                      query, len(uids))
+        if not uids:
+            return []
+
+        self._note_writer(sender)
+        self._mark_dirty_many(uids)
+        try:
+            entries = []
+            for uid in uids:
+                metadata = self._metadata_store.retrieve(uid)
+                metadata.update(props)
+                metadata['uid'] = uid
+                entries.append((uid, metadata))
+            self._metadata_store.store_many(entries)
+            self._index_store.store_entries(entries)
+        except:
+            logger.exception('Exception updating entries')
+            self._release_failed(uids)
+            raise
+
+        self.BulkUpdated(uids)
+        self._mark_clean_many(uids)
+        return uids
+
+    @dbus.service.signal(DS_DBUS_INTERFACE, signature="as")
+    def BulkUpdated(self, uids):
+        pass
+
     def stop(self):
         """shutdown the service"""
+        self._read_pool.close()
+        self._index_pool.terminate()
         self._index_store.close_index()
         self.Stopped()
 
@@ -15,9 +15,14 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
+import ctypes
+import ctypes.util
 import errno
+import fcntl
 import logging
 import tempfile
+import threading
+import time
 
 from gi.repository import GLib
 
@@ -25,6 +30,41 @@ from sugar3 import env
 
 from carquinyol import layoutmanager
 
+# Bytes transferred per copy_file_range(), sendfile() or read() call
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# ioctl request sharing the extents of a file (reflink), from linux/fs.h
+_FICLONE = 0x40049409
+
+# Errors meaning a copy method is not supported for a pair of files, in
+# which case the next, slower one is tried
+_UNSUPPORTED_ERRORS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                       errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF)
+
+
+def _load_libc_function(name, restype, argtypes):
+    """Return a libc function through ctypes, or None if unavailable.
+
+    Python 2 exposes neither copy_file_range() nor sendfile().
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        function = getattr(libc, name)
+    except (OSError, AttributeError):
+        return None
+    function.restype = restype
+    function.argtypes = argtypes
+    return function
+
+
+_copy_file_range = _load_libc_function(
+    'copy_file_range', ctypes.c_ssize_t,
+    [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+     ctypes.c_size_t, ctypes.c_uint])
+_sendfile = _load_libc_function(
+    'sendfile', ctypes.c_ssize_t,
+    [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+
 
 class FileStore(object):
     """Handle the storage of one file per entry.
@@ -33,6 +73,12 @@ class FileStore(object):
     # TODO: add protection against store and retrieve operations on entries
     # that are being processed async.
 
+    def __init__(self, chunk_size=COPY_CHUNK_SIZE):
+        self._chunk_size = chunk_size
+        self._stats_lock = threading.Lock()
+        self._copy_stats = {'copies': 0, 'bytes': 0, 'reflinks': 0,
+                            'last_throughput': 0}
+
     def store(self, uid, file_path, transfer_ownership, completion_cb):
         """Store a file for a given entry.
 
@@ -87,9 +133,24 @@ class FileStore(object):
         logging.debug('FileStore copying from %r to %r', file_path,
             destination_path)
         async_copy = AsyncCopy(file_path, destination_path, completion_cb,
-                unlink_src)
+                unlink_src, chunk_size=self._chunk_size,
+                stats_cb=self._add_copy_stats)
         async_copy.start()
 
+    def _add_copy_stats(self, size, elapsed, method):
+        with self._stats_lock:
+            self._copy_stats['copies'] += 1
+            self._copy_stats['bytes'] += size
+            if method == 'reflink':
+                self._copy_stats['reflinks'] += 1
+            elif elapsed > 0:
+                self._copy_stats['last_throughput'] = int(size / elapsed)
+
+    def get_copy_stats(self):
+        """Return counters about the files copied so far."""
+        with self._stats_lock:
+            return dict(self._copy_stats)
+
     def retrieve(self, uid, user_id, extension):
         """Place the file associated to a given entry into a directory
            where the user can read it. The caller is reponsible for
@@ -159,16 +220,22 @@ class FileStore(object):
 
 
 class AsyncCopy(object):
-    """Copy a file in chunks in the idle loop.
+    """Copy a file in a worker thread.
 
+    Shares the extents of the source (reflink) if the file system supports
+    it, otherwise copies in the kernel using copy_file_range() or
+    sendfile(), falling back to read() and write(). The completion callback
+    runs in the main loop.
     """
-    CHUNK_SIZE = 65536
 
-    def __init__(self, src, dest, completion, unlink_src=False):
+    def __init__(self, src, dest, completion, unlink_src=False,
+                 chunk_size=COPY_CHUNK_SIZE, stats_cb=None):
         self.src = src
         self.dest = dest
         self.completion = completion
         self._unlink_src = unlink_src
+        self._chunk_size = chunk_size
+        self._stats_cb = stats_cb
         self.src_fp = -1
         self.dest_fp = -1
         self.written = 0
@@ -178,39 +245,84 @@ class AsyncCopy(object):
         os.close(self.src_fp)
         os.close(self.dest_fp)
 
-    def _copy_block(self, user_data=None):
+    def _reflink(self):
         try:
-            data = os.read(self.src_fp, AsyncCopy.CHUNK_SIZE)
-            count = os.write(self.dest_fp, data)
-            self.written += len(data)
-
-            # error writing data to file?
-            if count < len(data):
-                logging.error('AC: Error writing %s -> %s: wrote less than '
-                        'expected', self.src, self.dest)
-                self._complete(RuntimeError(
-                        'Error writing data to destination file'))
+            fcntl.ioctl(self.dest_fp, _FICLONE, self.src_fp)
+        except IOError, e:
+            if e.errno in _UNSUPPORTED_ERRORS:
                 return False
+            raise
+        self.written = self.size
+        return True
 
-            # FIXME: emit progress here
-
-            # done?
-            if len(data) < AsyncCopy.CHUNK_SIZE:
-                self._complete(None)
+    def _copy_in_kernel(self, function):
+        # Both functions advance the file offsets, so a method taking
+        # over after a partial copy continues where this one stopped.
+        while self.written < self.size:
+            count = function(self._chunk_size)
+            if count < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+                if err in _UNSUPPORTED_ERRORS:
+                    return False
+                raise OSError(err, os.strerror(err))
+            if count == 0:
+                # Some file systems copy nothing instead of failing, and
+                # the source may have been truncated meanwhile: let the
+                # next method carry on, read() will tell the end of file.
                 return False
-        except Exception, err:
-            logging.error('AC: Error copying %s -> %s: %r', self.src, self.
-                dest, err)
-            self._complete(err)
-            return False
-
+            self.written += count
         return True
 
+    def _copy_blocks(self):
+        while True:
+            data = os.read(self.src_fp, self._chunk_size)
+            if not data:
+                return
+            while data:
+                count = os.write(self.dest_fp, data)
+                data = data[count:]
+                self.written += count
+
+    def _copy(self):
+        if self._reflink():
+            return 'reflink'
+        if _copy_file_range is not None and self._copy_in_kernel(
+                lambda count: _copy_file_range(self.src_fp, None,
+                                               self.dest_fp, None, count, 0)):
+            return 'copy_file_range'
+        if _sendfile is not None and self._copy_in_kernel(
+                lambda count: _sendfile(self.dest_fp, self.src_fp, None,
+                                        count)):
+            return 'sendfile'
+        self._copy_blocks()
+        return 'read/write'
+
+    def _run(self):
+        start_time = time.time()
+        try:
+            method = self._copy()
+        except Exception, err:
+            logging.error('AC: Error copying %s -> %s: %r', self.src,
+                self.dest, err)
+            GLib.idle_add(self._complete, err)
+            return
+
+        elapsed = time.time() - start_time
+        logging.debug('AC: Copied %d bytes %s -> %s using %s in %.3fs '
+            '(%.1f MiB/s)', self.written, self.src, self.dest, method,
+            elapsed, self.written / max(elapsed, 1e-6) / 1024 / 1024)
+        if self._stats_cb is not None:
+            self._stats_cb(self.written, elapsed, method)
+        GLib.idle_add(self._complete, None)
+
     def _complete(self, *args):
         self._cleanup()
         if self._unlink_src:
             os.unlink(self.src)
         self.completion(*args)
+        return False
 
     def start(self):
         if os.path.exists(self.dest):
@@ -223,4 +335,6 @@ class AsyncCopy(object):
         stat = os.fstat(self.src_fp)
         self.size = stat[6]
 
-        GLib.idle_add(self._copy_block)
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
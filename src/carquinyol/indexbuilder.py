@@ -0,0 +1,254 @@
+# Copyright (C) 2008, One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Bulk (re)indexing of entries using a pool of worker processes.
+
+Workers read the metadata of an entry, complete missing properties and
+generate the index document. The documents are sent back serialised and
+a single writer, running in the main loop, adds them to the index in
+batches and writes the completed properties back.
+
+The worker processes are forked from a pool created by create_pool()
+before the service starts any thread, as forking a process that runs
+threads may leave the child with locks it can never take. The pool lives
+for the whole session although rebuilds are rare, so by default it is
+kept small (see MAX_WORKERS).
+"""
+
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+
+from gi.repository import GLib
+import xapian
+
+from carquinyol import layoutmanager
+from carquinyol import migration
+from carquinyol.filestore import FileStore
+from carquinyol.indexstore import build_document
+from carquinyol.metadatastore import MetadataStore
+
+# Number of documents the writer commits at once
+_BATCH_SIZE = 100
+
+# How often, in milliseconds, the writer collects worker results
+_POLL_INTERVAL = 50
+
+# Log progress every _n_ entries
+_PROGRESS_INTERVAL = 500
+
+# Number of properties listed when reporting the index size per property
+_SIZE_REPORT_LENGTH = 10
+
+# Upper bound of the default number of worker processes. Each idle worker
+# is a forked interpreter whose memory stops being shared with the
+# service as soon as either of them touches it.
+MAX_WORKERS = 4
+
+# The MetadataStore of the worker process, see _get_metadata_store()
+_metadata_store = None
+
+
+def complete_properties(uid, props):
+    """Fill in properties that older entries may lack.
+
+    Returns True if props was changed and should be written back.
+    """
+    update_metadata = False
+    if 'filesize' not in props:
+        path = FileStore().get_file_path(uid)
+        if os.path.exists(path):
+            props['filesize'] = os.stat(path).st_size
+            update_metadata = True
+    if 'timestamp' not in props:
+        props['timestamp'] = str(int(time.time()))
+        update_metadata = True
+    if 'creation_time' not in props:
+        if 'ctime' in props:
+            try:
+                props['creation_time'] = time.mktime(
+                    time.strptime(props['ctime'], migration.DATE_FORMAT))
+            except (TypeError, ValueError):
+                pass
+        if 'creation_time' not in props:
+            props['creation_time'] = props['timestamp']
+        update_metadata = True
+    return update_metadata
+
+
+def get_default_workers():
+    """Return the number of worker processes to use by default."""
+    return min(multiprocessing.cpu_count(), MAX_WORKERS)
+
+
+def create_pool(workers=None):
+    """Return a pool of worker processes for IndexBuilder."""
+    return multiprocessing.Pool(workers or get_default_workers())
+
+
+def _get_metadata_store():
+    """Return the MetadataStore of the current worker process."""
+    global _metadata_store
+    if _metadata_store is None:
+        # every entry is read only once, caching would only cost memory
+        _metadata_store = MetadataStore(cache_bytes=0)
+    return _metadata_store
+
+
+def _prepare_entry(uid):
+    """Complete the metadata of an entry and build its index document.
+
+    Runs in a worker process. Returns (uid, serialised document, indexed
+    sizes, completed properties), the document being None if the entry
+    could not be read. Only the main loop writes metadata, as it may be
+    changing the entry meanwhile.
+    """
+    try:
+        props = _get_metadata_store().retrieve(uid)
+        present = set(props)
+        completed = {}
+        if complete_properties(uid, props):
+            completed = dict((key, value) for key, value in props.items()
+                             if key not in present)
+        sizes = {}
+        return (uid, build_document(uid, props, sizes).serialise(), sizes,
+                completed)
+    except Exception:
+        logging.exception('Error processing %r', uid)
+        return uid, None, None, None
+
+
+class IndexBuilder(object):
+    """Add a set of entries to the index without blocking the main loop.
+    """
+
+    def __init__(self, index_store, metadata_store, uids, pool, workers,
+                 progress_cb=None, completion_cb=None):
+        self._index_store = index_store
+        self._metadata_store = metadata_store
+        self._uids = uids
+        self._pool = pool
+        self._workers = workers
+        self._progress_cb = progress_cb
+        self._completion_cb = completion_cb
+        self._results = None
+        self._batch = []
+        self._done = 0
+        self._total = 0
+        self._start_time = None
+
+    def start(self):
+        uids = [uid for uid in self._uids
+                if self._index_store.needs_indexing(uid)]
+        self._total = len(uids)
+        self._start_time = time.time()
+        logging.debug('Indexing %d entries using %d workers', self._total,
+                      self._workers)
+
+        if not uids:
+            GLib.idle_add(self._complete)
+            return
+
+        self._results = self._pool.imap_unordered(
+            _prepare_entry, uids,
+            chunksize=max(1, min(_BATCH_SIZE, len(uids) / self._workers)))
+        GLib.timeout_add(_POLL_INTERVAL, self._write_cb,
+                         priority=GLib.PRIORITY_LOW)
+
+    def get_progress(self):
+        """Return a (done, total) tuple."""
+        return self._done, self._total
+
+    def _write_cb(self):
+        # only take the results that are ready, never block the main loop
+        while len(self._batch) < _BATCH_SIZE and \
+                self._done < self._total:
+            try:
+                uid, data, sizes, completed = self._results.next(0)
+            except multiprocessing.TimeoutError:
+                break
+            self._done += 1
+
+            if data is None:
+                self._delete_corrupt_entry(uid)
+            else:
+                if completed:
+                    self._write_completed(uid, completed)
+                self._batch.append((uid, xapian.Document.unserialise(data)))
+                self._index_store.add_indexed_sizes(sizes)
+
+            if self._done % _PROGRESS_INTERVAL == 0:
+                self._report_progress()
+
+        if len(self._batch) >= _BATCH_SIZE or self._done == self._total:
+            self._index_store.add_documents(self._batch)
+            self._batch = []
+
+        if self._done < self._total:
+            return True
+
+        self._results = None
+        self._report_progress()
+        self._report_sizes()
+        self._complete()
+        return False
+
+    def _report_progress(self):
+        elapsed = time.time() - self._start_time
+        logging.debug('Indexed %d of %d entries in %.1fs', self._done,
+                      self._total, elapsed)
+        if self._progress_cb is not None:
+            self._progress_cb(self._done, self._total)
+
+    def _report_sizes(self):
+        for name, entries, indexed, left_out in \
+                self._index_store.get_indexed_sizes()[:_SIZE_REPORT_LENGTH]:
+            logging.debug('Indexed %d bytes of %r in %d entries, left out '
+                          '%d bytes', indexed, name, entries, left_out)
+
+    def _write_completed(self, uid, completed):
+        """Store the properties a worker completed, unless the entry got
+        them meanwhile."""
+        try:
+            present = self._metadata_store.retrieve(uid, completed.keys())
+            missing = dict((key, value) for key, value in completed.items()
+                           if key not in present)
+            if missing:
+                self._metadata_store.update(uid, missing, [])
+        except Exception:
+            logging.exception('Error completing the metadata of %r', uid)
+
+    def _delete_corrupt_entry(self, uid):
+        layout_manager = layoutmanager.get_instance()
+        if os.path.isdir(layout_manager.get_metadata_path(uid)):
+            logging.warn('Entry %r still has the metadata directory of '
+                         'layout version 6, leaving it alone', uid)
+            return
+
+        logging.warn('Will attempt to delete corrupt entry %r', uid)
+        try:
+            # DataStore.delete() only works on well-formed entries :-/
+            entry_path = layout_manager.get_entry_path(uid)
+            shutil.rmtree(entry_path)
+        except Exception:
+            logging.exception('Error deleting corrupt entry %r', uid)
+
+    def _complete(self):
+        if self._completion_cb is not None:
+            self._completion_cb()
+        return False
@@ -14,13 +14,22 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+import base64
+import collections
+import fnmatch
+import heapq
+import locale
 import logging
+import marshal
 import os
+import shutil
 import sys
+import threading
+import time
 
 from gi.repository import GLib
 import xapian
-from xapian import WritableDatabase, Document, Enquire, Query
+from xapian import Database, WritableDatabase, Document, Enquire, Query
 
 from carquinyol import layoutmanager
 from carquinyol.layoutmanager import MAX_QUERY_LIMIT
@@ -31,6 +40,11 @@ _VALUE_TITLE = 2
 # 3 reserved for version support
 _VALUE_FILESIZE = 4
 _VALUE_CREATION_TIME = 5
+_VALUE_DESCRIPTION = 6
+
+# Bump to have existing indexes rebuilt when the way documents are
+# indexed changes
+_INDEX_FORMAT = '3'
 
 _PREFIX_NONE = 'N'
 _PREFIX_FULL_VALUE = 'F'
@@ -40,17 +54,71 @@ _PREFIX_ACTIVITY_ID = 'I'
 _PREFIX_MIME_TYPE = 'M'
 _PREFIX_KEEP = 'K'
 _PREFIX_PROJECT_ID = 'P'
+# followed by the upper-cased property name and a colon, see
+# _get_exact_prefix()
+_PREFIX_EXACT = 'X'
 
 # Force a flush every _n_ changes to the db
 _FLUSH_THRESHOLD = 20
 
-# Force a flush after _n_ seconds since the last change to the db
+# Force a flush after _n_ seconds since the first uncommitted change
 _FLUSH_TIMEOUT = 5
 
-_PROPERTIES_NOT_TO_INDEX = ['timestamp', 'preview', 'launch-times']
+# Force a flush once about _n_ bytes of indexed text are pending
+_FLUSH_MAX_BYTES = 1024 * 1024
+
+_INTENT_STORE = '+'
+_INTENT_DELETE = '-'
+
+_INDEX_FULLTEXT = 'fulltext'
+_INDEX_EXACT = 'exact'
+_INDEX_NONE = 'none'
+
+# How each property gets indexed: as words (fulltext), as a single term
+# holding the whole value (exact) or not at all. The first pattern (see
+# fnmatch) matching the property name applies. max_length caps the number
+# of bytes of the value that get indexed, None meaning no limit.
+# Properties listed in _QUERY_TERM_MAP always get the whole value term,
+# unless they are not indexed at all. Query strings match exact
+# properties with name:value only if the pattern is a plain name.
+_INDEX_POLICY = [
+    # (pattern, mode, max_length)
+    ('timestamp', _INDEX_NONE, None),
+    ('creation_time', _INDEX_NONE, None),
+    ('preview', _INDEX_NONE, None),
+    ('launch-times', _INDEX_NONE, None),
+    ('checksum', _INDEX_NONE, None),
+    ('filesize', _INDEX_NONE, None),
+    ('uid', _INDEX_EXACT, None),
+    ('activity_id', _INDEX_EXACT, None),
+    ('project_id', _INDEX_EXACT, None),
+    ('title', _INDEX_FULLTEXT, 1024),
+    ('description', _INDEX_FULLTEXT, 16 * 1024),
+    ('tags', _INDEX_FULLTEXT, 4096),
+    ('buddies', _INDEX_FULLTEXT, 4096),
+    ('*', _INDEX_FULLTEXT, 4096),
+]
+
+# Xapian rejects terms longer than 245 bytes
+_MAX_TERM_LENGTH = 240
+
+# Properties copied into the document data, so that find() can answer
+# queries for them without reading the metadata of each entry. Entries
+# need to be reindexed for changes to take effect.
+_COVERED_PROPERTIES = ['title', 'mime_type', 'activity', 'timestamp', 'keep',
+                       'buddies']
+
+# Properties find() fills in without reading the metadata of the entries
+_INTERNAL_PROPERTIES = ['uid', 'filesize']
 
 _MAX_RESULTS = int(2 ** 31 - 1)
 
+# Number of find() results to keep in memory
+_QUERY_CACHE_SIZE = 64
+
+# Number of suggest() results to keep in memory
+_SUGGEST_CACHE_SIZE = 32
+
 _QUERY_TERM_MAP = {
     'uid': _PREFIX_UID,
     'activity': _PREFIX_ACTIVITY,
@@ -60,6 +128,28 @@ _QUERY_TERM_MAP = {
     'project_id': _PREFIX_PROJECT_ID,
 }
 
+# Properties that can be sorted on and the value slots they are stored
+# in. Strings are stored as collation keys of the current locale, so
+# Xapian sorts them the way the user expects. Add an entry (with a new
+# slot) to make another property sortable.
+_SORT_VALUE_MAP = {
+    'timestamp': {'number': _VALUE_TIMESTAMP, 'type': float},
+    'title': {'number': _VALUE_TITLE, 'type': unicode},
+    'filesize': {'number': _VALUE_FILESIZE, 'type': int},
+    'creation_time': {'number': _VALUE_CREATION_TIME, 'type': float},
+    'description': {'number': _VALUE_DESCRIPTION, 'type': unicode},
+}
+
+# Properties that can be enumerated with counts by get_facets()
+_FACET_PROPERTIES = [name for name in _QUERY_TERM_MAP if name != 'uid']
+
+_TIMELINE_PROPERTIES = {
+    'timestamp': _VALUE_TIMESTAMP,
+    'creation_time': _VALUE_CREATION_TIME,
+}
+
+_TIMELINE_BUCKETS = ['hour', 'day', 'week', 'month']
+
 _QUERY_VALUE_MAP = {
     'timestamp': {'number': _VALUE_TIMESTAMP, 'type': float},
     'filesize': {'number': _VALUE_FILESIZE, 'type': int},
@@ -67,27 +157,58 @@ _QUERY_VALUE_MAP = {
 }
 
 
+def _get_collation():
+    """Return the locale _make_sort_key() collates strings for."""
+    return locale.setlocale(locale.LC_COLLATE)
+
+
+def _make_sort_key(info, value):
+    if info['type'] is not unicode:
+        return xapian.sortable_serialise(info['type'](value))
+
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    value = str(value).strip()
+    try:
+        return locale.strxfrm(value)
+    except ValueError:
+        # embedded NUL characters
+        return value
+
+
+def _get_index_policy(name):
+    """Return the (mode, max_length) tuple that applies to a property."""
+    for pattern, mode, max_length in _INDEX_POLICY:
+        if fnmatch.fnmatchcase(name, pattern):
+            return mode, max_length
+    return _INDEX_NONE, None
+
+
+def _get_exact_prefix(name):
+    """Return the prefix of the whole value term of a property."""
+    if name in _QUERY_TERM_MAP:
+        return _PREFIX_FULL_VALUE + _QUERY_TERM_MAP[name]
+    return _PREFIX_EXACT + name.upper() + ':'
+
+
 class TermGenerator (xapian.TermGenerator):
 
+    def __init__(self, sizes=None):
+        xapian.TermGenerator.__init__(self)
+        # property name -> [entries, bytes indexed, bytes left out]
+        self._sizes = sizes
+
     def index_document(self, document, properties):
-        document.add_value(_VALUE_TIMESTAMP,
-            xapian.sortable_serialise(float(properties['timestamp'])))
-        document.add_value(_VALUE_TITLE, properties.get('title', '').strip())
-        if 'filesize' in properties:
-            try:
-                document.add_value(_VALUE_FILESIZE,
-                    xapian.sortable_serialise(int(properties['filesize'])))
-            except (ValueError, TypeError):
-                logging.debug('Invalid value for filesize property: %s',
-                              properties['filesize'])
-        if 'creation_time' in properties:
+        for name, info in _SORT_VALUE_MAP.items():
+            if name not in properties and info['type'] is not unicode:
+                continue
+            value = properties.get(name, '')
             try:
-                document.add_value(
-                    _VALUE_CREATION_TIME, xapian.sortable_serialise(
-                        float(properties['creation_time'])))
+                document.add_value(info['number'],
+                                   _make_sort_key(info, value))
             except (ValueError, TypeError):
-                logging.debug('Invalid value for creation_time property: %s',
-                              properties['creation_time'])
+                logging.debug('Invalid value for %s property: %s', name,
+                              value)
 
         self.set_document(document)
 
@@ -107,7 +228,8 @@ class TermGenerator (xapian.TermGenerator):
             self._index_property(document, name, value)
 
     def _index_property(self, doc, name, value, prefix=''):
-        if name in _PROPERTIES_NOT_TO_INDEX or not value:
+        mode, max_length = _get_index_policy(name)
+        if mode == _INDEX_NONE or not value:
             return
 
         if isinstance(value, unicode):
@@ -115,14 +237,150 @@ class TermGenerator (xapian.TermGenerator):
         elif not isinstance(value, basestring):
             value = str(value)
 
+        length = len(value)
+        if max_length is not None and length > max_length:
+            value = value[:max_length]
+
         # We need to add the full value (i.e. not split into words) so
         # we can enumerate unique values. It also simplifies setting up
         # dictionary-based queries.
-        if prefix:
-            doc.add_term(_PREFIX_FULL_VALUE + prefix + value)
+        if prefix or mode == _INDEX_EXACT:
+            term = _get_exact_prefix(name) + value
+            if len(term) <= _MAX_TERM_LENGTH:
+                doc.add_term(term)
+
+        if mode == _INDEX_FULLTEXT:
+            # the words are what QueryParser matches, e.g. for activity:...
+            self.index_text(value, 1, prefix or _PREFIX_NONE)
+            self.increase_termpos()
+
+        if self._sizes is not None:
+            sizes = self._sizes.setdefault(name, [0, 0, 0])
+            sizes[0] += 1
+            sizes[1] += len(value)
+            sizes[2] += length - len(value)
+
+
+class _FacetSpy(xapian.MatchSpy):
+    """Count the full-value terms of some prefixes over a match set."""
+
+    def __init__(self, prefixes):
+        xapian.MatchSpy.__init__(self)
+        self.counts = dict((prefix, {}) for prefix in prefixes)
+
+    def __call__(self, document, weight):
+        # Walk the term list from the start: TermIter.skip_to() positions
+        # the iterator on the first match, which iterating would then skip.
+        full_prefixes = [(_PREFIX_FULL_VALUE + prefix, counts)
+                         for prefix, counts in self.counts.items()]
+        for item in document.termlist():
+            term = item.term
+            if not term.startswith(_PREFIX_FULL_VALUE):
+                if term > _PREFIX_FULL_VALUE:
+                    # the term list is sorted
+                    break
+                continue
+            for full_prefix, counts in full_prefixes:
+                if term.startswith(full_prefix):
+                    value = term[len(full_prefix):]
+                    counts[value] = counts.get(value, 0) + 1
 
-        self.index_text(value, 1, prefix or _PREFIX_NONE)
-        self.increase_termpos()
+
+def _get_bucket(timestamp, bucket):
+    """Return the (start, end) local time interval containing timestamp.
+    """
+    tm = time.localtime(timestamp)
+    year, month, day = tm.tm_year, tm.tm_mon, tm.tm_mday
+    if bucket == 'hour':
+        start = (year, month, day, tm.tm_hour)
+        end = (year, month, day, tm.tm_hour + 1)
+    elif bucket == 'day':
+        start = (year, month, day, 0)
+        end = (year, month, day + 1, 0)
+    elif bucket == 'week':
+        start = (year, month, day - tm.tm_wday, 0)
+        end = (year, month, day - tm.tm_wday + 7, 0)
+    elif month == 12:
+        start = (year, month, 1, 0)
+        end = (year + 1, 1, 1, 0)
+    else:
+        start = (year, month, 1, 0)
+        end = (year, month + 1, 1, 0)
+
+    # mktime() normalises out of range days and hours
+    return [int(time.mktime(fields + (0, 0, 0, 0, -1)))
+            for fields in [start, end]]
+
+
+def _freeze(value):
+    """Turn a (possibly nested) query value into a hashable cache key."""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item))
+                            for key, item in value.items()))
+    elif isinstance(value, list):
+        return ('list', ) + tuple(_freeze(item) for item in value)
+    elif isinstance(value, tuple):
+        return ('tuple', ) + tuple(_freeze(item) for item in value)
+    return value
+
+
+def _encode_cursor(order_by, value, uid, position):
+    return ':'.join([base64.urlsafe_b64encode(str(part))
+                     for part in (order_by, value, uid, position)])
+
+
+def _decode_cursor(cursor):
+    try:
+        order_by, value, uid, position = [base64.urlsafe_b64decode(str(part))
+                                          for part in cursor.split(':')]
+        return order_by, value, uid, int(position)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor %r' % cursor)
+
+
+def _query_value_after(slot, value, reverse):
+    """Match documents whose value in slot sorts strictly after value."""
+    if reverse:
+        before = Query(Query.OP_AND_NOT, Query(Query.OP_VALUE_LE, slot, value),
+                       Query(Query.OP_VALUE_RANGE, slot, value, value))
+        # documents without a value sort last
+        missing = Query(Query.OP_AND_NOT, Query(''),
+                        Query(Query.OP_VALUE_GE, slot, ''))
+        return Query(Query.OP_OR, before, missing)
+    # value + '\0' is the smallest string greater than value
+    return Query(Query.OP_VALUE_GE, slot, value + '\0')
+
+
+def _parse_cursor(slot, reverse, value, uid):
+    """Match the documents that sort after (value, uid)."""
+    same_value = Query(Query.OP_AND,
+                       Query(Query.OP_VALUE_RANGE, slot, value, value),
+                       _query_value_after(_VALUE_UID, uid, reverse))
+    return Query(Query.OP_OR, _query_value_after(slot, value, reverse),
+                 same_value)
+
+
+def build_document(uid, properties, sizes=None):
+    """Build the index document of an entry.
+
+    Does not need an open database, so it can run in worker processes.
+    If given, sizes gets the number of bytes indexed per property added
+    (see IndexStore.get_indexed_sizes()).
+    """
+    document = Document()
+    document.add_value(_VALUE_UID, uid)
+    term_generator = TermGenerator(sizes)
+    term_generator.index_document(document, properties)
+
+    covered = {}
+    for name in _COVERED_PROPERTIES:
+        if name in properties:
+            value = properties[name]
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            covered[name] = str(value)
+    document.set_data(marshal.dumps(covered))
+    return document
 
 
 class QueryParser (xapian.QueryParser):
@@ -139,8 +397,15 @@ class QueryParser (xapian.QueryParser):
         xapian.QueryParser.__init__(self)
 
         for name, prefix in _QUERY_TERM_MAP.items():
-            self.add_prefix(name, prefix)
-            self.add_prefix('', prefix)
+            if _get_index_policy(name)[0] == _INDEX_FULLTEXT:
+                self.add_prefix(name, prefix)
+                self.add_prefix('', prefix)
+
+        # name:value matches the whole value of exact properties
+        for pattern, __, __ in _INDEX_POLICY:
+            if _get_index_policy(pattern)[0] == _INDEX_EXACT and \
+                    not set('*?[') & set(pattern):
+                self.add_boolean_prefix(pattern, _get_exact_prefix(pattern))
 
         self.add_prefix('', _PREFIX_NONE)
 
@@ -153,7 +418,7 @@ class QueryParser (xapian.QueryParser):
         elif prefix:
             return Query(_PREFIX_FULL_VALUE + prefix + str(value))
         else:
-            return Query(_PREFIX_NONE + str(value))
+            return Query(_get_exact_prefix(name) + str(value))
 
     def _parse_query_value_range(self, name, info, value):
         if len(value) != 2:
@@ -219,6 +484,8 @@ class QueryParser (xapian.QueryParser):
             elif name in _QUERY_VALUE_MAP:
                 queries.append(self._parse_query_value(name,
                     _QUERY_VALUE_MAP[name], value))
+            elif _get_index_policy(name)[0] == _INDEX_EXACT:
+                queries.append(self._parse_query_term(name, '', value))
             else:
                 logging.warning('Unknown term: %r=%r', name, value)
 
@@ -229,19 +496,60 @@ class QueryParser (xapian.QueryParser):
         return Query(Query.OP_AND, queries)
 
 
+def _compact_database(source, destination):
+    if hasattr(Database, 'compact'):
+        Database(source).compact(destination)
+    else:
+        compactor = xapian.Compactor()
+        compactor.set_destdir(destination)
+        compactor.add_source(source)
+        compactor.compact()
+
+
+def _get_shard_name(number):
+    return 'shard-%02d' % number
+
+
 class IndexStore(object):
     """Index metadata and provide rich query facilities on it.
+
+    With shards > 1 the documents are split across that many databases by
+    uid prefix, like the entries are in the data store directory. Queries
+    run on a combined database over all shards.
     """
 
-    def __init__(self):
+    def __init__(self, shards=1):
         self._database = None
+        self._shards = []
+        self._shard_count = shards
         self._flush_timeout = None
         self._pending_writes = 0
+        self._pending_bytes = 0
+        self._intent_log = None
+        self._revision = 0
+        self._commits = 0
+        self._indexed_sizes = {}
+        self._query_cache = collections.OrderedDict()
+        self._query_cache_revision = 0
+        self._cache_hits = 0
+        self._cache_misses = 0
+        self._suggest_cache = collections.OrderedDict()
+        self._suggest_cache_version = None
+        self._cache_lock = threading.Lock()
+        # held while the index directories are replaced, see _swap_in()
+        self._swap_lock = threading.Lock()
+        self._main_thread = threading.current_thread()
+        self._thread_local = threading.local()
+        self._generation = 0
         root_path=layoutmanager.get_instance().get_root_path()
         self._index_updated_path = os.path.join(root_path,
                                                 'index_updated')
+        self._intent_log_path = os.path.join(root_path, 'index_intents')
         self._std_index_path = layoutmanager.get_instance().get_index_path()
         self._index_path = self._std_index_path
+        self._shadow_path = None
+        self._shadow_shards = []
+        self._shadow_touched = set()
 
     def open_index(self, temp_path=False):
         # callers to open_index must be able to
@@ -257,13 +565,226 @@ class IndexStore(object):
             self._index_path = temp_path
         else:
              self._index_path = self._std_index_path
+        self._revision += 1
+        self._generation += 1
         try:
-             self._database = WritableDatabase(self._index_path,
-                                               xapian.DB_CREATE_OR_OPEN)
+            self._shards, self._database = self._open_databases(
+                self._index_path)
         except Exception as e:
              logging.error('Exception opening database')
              raise
 
+    def _open_databases(self, path):
+        """Open the index at path, creating it if needed.
+
+        Returns the list of writable shards and the database to query.
+        """
+        self._check_layout(path)
+        if self._shard_count == 1:
+            shards = [WritableDatabase(path, xapian.DB_CREATE_OR_OPEN)]
+            database = shards[0]
+        else:
+            shards = []
+            database = Database()
+            for number in range(self._shard_count):
+                shard_path = os.path.join(path, _get_shard_name(number))
+                shard = WritableDatabase(shard_path, xapian.DB_CREATE_OR_OPEN)
+                shards.append(shard)
+                database.add_database(shard)
+
+        # sort keys of strings only compare within the same collation
+        collation = _get_collation()
+        for shard in shards:
+            index_format = shard.get_metadata('format')
+            index_collation = shard.get_metadata('collation')
+            if not shard.get_doccount():
+                shard.set_metadata('format', _INDEX_FORMAT)
+                shard.set_metadata('collation', collation)
+            elif index_format != _INDEX_FORMAT:
+                raise ValueError('Index format %r is outdated' % index_format)
+            elif index_collation != collation:
+                raise ValueError('Index collated for locale %r, not %r' %
+                                 (index_collation, collation))
+
+        return shards, database
+
+    def _check_layout(self, path):
+        """Make sure the index on disk has the configured number of shards.
+        """
+        if not os.path.exists(path):
+            return
+        names = set(os.listdir(path))
+        shard_names = set(_get_shard_name(number)
+                          for number in range(self._shard_count))
+        if not names:
+            return
+        if self._shard_count == 1 and \
+                [name for name in names if name.startswith('shard-')]:
+            raise ValueError('Index is sharded, expected a single database')
+        if self._shard_count > 1 and names != shard_names:
+            raise ValueError('Index does not have %d shards' %
+                             self._shard_count)
+
+    def _get_shard(self, uid, shards=None):
+        if shards is None:
+            shards = self._shards
+        if self._shard_count == 1:
+            return shards[0]
+        try:
+            return shards[int(uid[:2], 16) % self._shard_count]
+        except ValueError:
+            # not a uid we generated, e.g. a bogus one passed by a client;
+            # any fixed shard will do as it is looked up the same way
+            return shards[0]
+
+    def is_open(self):
+        return self._database is not None
+
+    def is_empty(self):
+        return not self._database.get_doccount()
+
+    def is_temporary(self):
+        """Return True if the index lives in tmpfs for lack of disk space."""
+        return self._index_path != self._std_index_path
+
+    def get_index_size(self):
+        """Return the size in bytes of the index in use."""
+        size = 0
+        for dir_path, dir_names_, file_names in os.walk(self._index_path):
+            for name in file_names:
+                size += os.path.getsize(os.path.join(dir_path, name))
+        return size
+
+    def start_shadow(self, path):
+        """Start building a new index at path, next to the live one.
+
+        Until finish_shadow() is called, the live index (if open) keeps
+        answering queries, store() and delete() change both indexes and
+        add_documents() only fills the new one.
+        """
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        # a crash before the swap has to restart the rebuild
+        self._set_index_updated(False)
+        self._shadow_path = path
+        self._shadow_shards = self._open_databases(path)[0]
+        self._shadow_touched = set()
+
+    def finish_shadow(self):
+        """Replace the live index by the one built since start_shadow()."""
+        for shard in self._shadow_shards:
+            shard.flush()
+        self._shadow_shards = []
+        self._shadow_touched = set()
+        shadow_path, self._shadow_path = self._shadow_path, None
+
+        self.close_index()
+        self._clear_intents()
+        # close_index() marked the live index up to date, a crash while
+        # swapping must not leave the marker behind without an index
+        self._set_index_updated(False)
+        with self._swap_lock:
+            if self._index_path != self._std_index_path:
+                # the live index was a temporary one
+                shutil.rmtree(self._index_path, ignore_errors=True)
+
+            if os.path.dirname(shadow_path) != \
+                    os.path.dirname(self._std_index_path):
+                # built in tmpfs for lack of disk space, keep using it there
+                self.open_index(temp_path=shadow_path)
+                return
+
+            self._swap_in(shadow_path)
+
+    def _swap_in(self, path):
+        """Move the index at path in place of the (closed) live one.
+
+        The index must be marked stale, it gets marked up to date once the
+        new one is open. The caller must hold _swap_lock, so that read
+        threads do not open the index halfway through.
+        """
+        old_path = self._std_index_path + '.old'
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+        if os.path.exists(self._std_index_path):
+            os.rename(self._std_index_path, old_path)
+        os.rename(path, self._std_index_path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+
+        self.open_index()
+        self._set_index_updated(True)
+
+    def compact_to(self, path):
+        """Write a compacted copy of the committed index to path.
+
+        Only reads the index, so it can run in a thread while the main
+        loop keeps using it.
+        """
+        if self._shard_count == 1:
+            _compact_database(self._index_path, path)
+            return
+
+        os.makedirs(path)
+        for number in range(self._shard_count):
+            name = _get_shard_name(number)
+            _compact_database(os.path.join(self._index_path, name),
+                              os.path.join(path, name))
+
+    def replace_index(self, path):
+        """Replace the live index by the compacted copy at path."""
+        self.close_index()
+        self._clear_intents()
+        # see finish_shadow()
+        self._set_index_updated(False)
+        with self._swap_lock:
+            self._swap_in(path)
+
+        # remember how big a freshly compacted index is
+        doccount = self._database.get_doccount()
+        if doccount:
+            self._shards[0].set_metadata('compacted_size',
+                repr(self.get_index_size() / float(doccount)))
+            self._flush(True)
+
+    def get_fragmentation(self):
+        """Estimate how much bigger the index is than a compacted one.
+
+        Compares the size per document with the one measured right after
+        the last compaction. Returns None if that is unknown.
+        """
+        compacted_size = self._shards[0].get_metadata('compacted_size')
+        doccount = self._database.get_doccount()
+        if not compacted_size or not doccount:
+            return None
+        return self.get_index_size() / float(doccount) / float(compacted_size)
+
+    def measure_query_latency(self, repeat=5):
+        """Return the average time, in seconds, of a typical Journal query.
+
+        The result cache is bypassed.
+        """
+        start = time.time()
+        for i_ in range(repeat):
+            self._query(self._database, {}, None, '+timestamp', 0, 50, None)
+        return (time.time() - start) / repeat
+
+    def get_revision(self):
+        return self._revision
+
+    revision = property(get_revision)
+
+    def get_commit_count(self):
+        """Return the number of commits made so far."""
+        return self._commits
+
+    def needs_indexing(self, uid):
+        """Return True if a bulk (re)index should add uid."""
+        if self._shadow_shards:
+            return uid not in self._shadow_touched
+        return not self.contains(uid)
+
     def close_index(self):
         """Close index database if it is open."""
         if not self._database:
@@ -273,18 +794,13 @@ class IndexStore(object):
         try:
             # does Xapian write in its destructors?
             self._database = None
+            self._shards = []
         except Exception as e:
             logging.error('Exception tearing down database')
             raise
 
-    def remove_index(self):
-        if not os.path.exists(self._index_path):
-            return
-        for f in os.listdir(self._index_path):
-            os.remove(os.path.join(self._index_path, f))
-
     def contains(self, uid):
-        postings = self._database.postlist(_PREFIX_FULL_VALUE + \
+        postings = self._get_shard(uid).postlist(_PREFIX_FULL_VALUE + \
             _PREFIX_UID + uid)
         try:
             __ = postings.next()
@@ -293,79 +809,551 @@ class IndexStore(object):
         return True
 
     def store(self, uid, properties):
-        document = Document()
-        document.add_value(_VALUE_UID, uid)
-        term_generator = TermGenerator()
-        term_generator.index_document(document, properties)
+        document = build_document(uid, properties, self._indexed_sizes)
+
+        self._revision += 1
+        if self._shadow_shards:
+            self._get_shard(uid, self._shadow_shards).replace_document(
+                _PREFIX_FULL_VALUE + _PREFIX_UID + uid, document)
+            self._shadow_touched.add(uid)
+        if self._database is None:
+            # only the index being rebuilt is open
+            return
 
-        if not self.contains(uid):
-            self._database.add_document(document)
-        else:
-            self._database.replace_document(_PREFIX_FULL_VALUE + \
-                _PREFIX_UID + uid, document)
+        self._log_intent(_INTENT_STORE, uid)
+        # adds the document if there is none for this uid yet
+        self._get_shard(uid).replace_document(
+            _PREFIX_FULL_VALUE + _PREFIX_UID + uid, document)
+
+        self._pending_bytes += self._estimate_size(properties)
+        self._flush()
+
+    def store_entries(self, entries):
+        """Like store() for a list of (uid, properties) pairs, committing
+        them all at once."""
+        documents = [(uid, build_document(uid, properties,
+                                          self._indexed_sizes))
+                     for uid, properties in entries]
+
+        self._revision += 1
+        if self._shadow_shards:
+            for uid, document in documents:
+                self._get_shard(uid, self._shadow_shards).replace_document(
+                    _PREFIX_FULL_VALUE + _PREFIX_UID + uid, document)
+                self._shadow_touched.add(uid)
+        if self._database is None:
+            return
 
+        self._log_intents(_INTENT_STORE, [uid for uid, __ in documents])
+        for uid, document in documents:
+            self._get_shard(uid).replace_document(
+                _PREFIX_FULL_VALUE + _PREFIX_UID + uid, document)
         self._flush(True)
 
+    def add_documents(self, documents):
+        """Add a batch of prebuilt (uid, document) pairs and commit them.
+
+        Used for bulk (re)indexing: no intents are logged and the index is
+        only marked up-to-date by the final flush(). While a shadow index
+        is being built the documents go there, except for the entries that
+        were changed since the rebuild started.
+        """
+        self._revision += 1
+        shards = set()
+        for uid, document in documents:
+            if not self._shadow_shards:
+                shard = self._get_shard(uid)
+            elif uid in self._shadow_touched:
+                continue
+            else:
+                shard = self._get_shard(uid, self._shadow_shards)
+            shard.replace_document(_PREFIX_FULL_VALUE + \
+                _PREFIX_UID + uid, document)
+            shards.add(shard)
+        for shard in shards:
+            shard.flush()
+        self._revision += 1
+
+    def _estimate_size(self, properties):
+        size = 0
+        for name, value in properties.items():
+            if not isinstance(value, basestring):
+                continue
+            mode, max_length = _get_index_policy(name)
+            if mode != _INDEX_NONE:
+                size += min(len(value), max_length or len(value))
+        return size
+
+    def add_indexed_sizes(self, sizes):
+        """Account for documents built elsewhere (see build_document()).
+        """
+        for name, (entries, indexed, left_out) in sizes.items():
+            total = self._indexed_sizes.setdefault(name, [0, 0, 0])
+            total[0] += entries
+            total[1] += indexed
+            total[2] += left_out
+
+    def get_indexed_sizes(self):
+        """Return how much of each property got indexed.
+
+        Returns a list of (name, entries, bytes indexed, bytes left out
+        because of the length caps) tuples, the properties taking the
+        most space in the index first. Only covers the entries indexed
+        since the service started, so all of them after a rebuild.
+        """
+        sizes = [(name, entries, indexed, left_out)
+                 for name, (entries, indexed, left_out)
+                 in self._indexed_sizes.items()]
+        sizes.sort(key=lambda item: item[2], reverse=True)
+        return sizes
+
     def find(self, query):
+        """Return the uids of the entries matching query.
+
+        Returns a (uids, total_count, cursor) tuple. Passing cursor back as
+        the 'cursor' key of the next query (instead of an offset) resumes
+        right after the last returned entry, at a cost that does not depend
+        on how deep into the results the client is. The cursor is empty on
+        the last page.
+        """
+        hits, total_count, cursor = self._find(query)
+        return ([hit[0] for hit in hits], total_count, cursor)
+
+    def count(self, query, exact=True):
+        """Return the number of entries matching query.
+
+        No document is read. If exact is False, the number is Xapian's
+        estimate, which is cheaper to get for large result sets.
+        """
+        query = dict(query)
+        for key in ['offset', 'limit', 'order_by', 'cursor']:
+            query.pop(key, None)
+        query_string = query.pop('query', None)
+
+        try:
+            cache_key = _freeze(('count', query, query_string, exact))
+            hash(cache_key)
+        except TypeError:
+            cache_key = None
+
+        revision = self._revision
+        cached = self._get_cached_result(cache_key)
+        if cached is not None:
+            return cached
+
+        count = self._read(self._count, query, query_string, exact)
+
+        self._cache_result(cache_key, count, revision)
+        return count
+
+    def _count(self, database, query, query_string, exact):
+        query_parser = QueryParser()
+        query_parser.set_database(database)
+        enquire = Enquire(database)
+        enquire.set_query(query_parser.parse_query(query, query_string))
+        if exact:
+            query_result = enquire.get_mset(0, 0, database.get_doccount())
+        else:
+            query_result = enquire.get_mset(0, 0)
+        return query_result.get_matches_estimated()
+
+    def get_timeline(self, query, name, bucket):
+        """Count the entries matching query per interval of time.
+
+        name is the time property to use ('timestamp' or 'creation_time')
+        and bucket the size of the intervals ('hour', 'day', 'week' or
+        'month', in local time). Returns a dictionary mapping the start of
+        each non-empty interval to the number of entries in it.
+        """
+        if name not in _TIMELINE_PROPERTIES:
+            raise ValueError('Unsupported timeline property %r' % name)
+        if bucket not in _TIMELINE_BUCKETS:
+            raise ValueError('Unsupported timeline bucket %r' % bucket)
+
+        query = dict(query or {})
+        for key in ['offset', 'limit', 'order_by', 'cursor']:
+            query.pop(key, None)
+        query_string = query.pop('query', None)
+
+        try:
+            cache_key = _freeze(('timeline', query, query_string, name,
+                                 bucket))
+            hash(cache_key)
+        except TypeError:
+            cache_key = None
+
+        revision = self._revision
+        cached = self._get_cached_result(cache_key)
+        if cached is not None:
+            return dict(cached)
+
+        timeline = self._read(self._get_timeline, query, query_string,
+                              _TIMELINE_PROPERTIES[name], bucket)
+
+        self._cache_result(cache_key, timeline, revision)
+        return dict(timeline)
+
+    def _get_timeline(self, database, query, query_string, slot, bucket):
+        query_parser = QueryParser()
+        query_parser.set_database(database)
+        enquire = Enquire(database)
+        enquire.set_query(query_parser.parse_query(query, query_string))
+        # Counting the distinct values happens inside Xapian while it
+        # runs the match, so no document gets read.
+        spy = xapian.ValueCountMatchSpy(slot)
+        enquire.add_matchspy(spy)
+        enquire.get_mset(0, 0, database.get_doccount())
+
+        # The values are sortable_serialise()d, so they come in ascending
+        # order and each bucket only needs computing once.
+        timeline = {}
+        start = end = None
+        for item in spy.values():
+            timestamp = xapian.sortable_unserialise(item.term)
+            if end is None or not start <= timestamp < end:
+                start, end = _get_bucket(timestamp, bucket)
+            timeline[start] = timeline.get(start, 0) + item.termfreq
+        return timeline
+
+    def affects_index(self, properties):
+        """Return True if changing properties requires reindexing."""
+        for name in properties:
+            if name in _SORT_VALUE_MAP or name in _COVERED_PROPERTIES or \
+                    name in _QUERY_TERM_MAP:
+                return True
+            if _get_index_policy(name)[0] != _INDEX_NONE:
+                return True
+        return False
+
+    def covers(self, properties):
+        """Return True if find_entries() can return all of properties."""
+        if not properties:
+            return False
+        for name in properties:
+            if name not in _INTERNAL_PROPERTIES and \
+                    name not in _COVERED_PROPERTIES:
+                return False
+        return True
+
+    def find_entries(self, query, properties):
+        """Like find(), but return the metadata of the entries as well.
+
+        properties must be covered by the index, see covers(). Returns a
+        list of (uid, metadata) pairs instead of uids. metadata is None for
+        entries indexed before their properties were copied to the index.
+        """
+        hits, total_count, cursor = self._find(query)
+        entries = []
+        for uid, data in hits:
+            if not data:
+                entries.append((uid, None))
+                continue
+            covered = marshal.loads(data)
+            metadata = {}
+            for name in properties:
+                if name in covered:
+                    metadata[name] = covered[name]
+            entries.append((uid, metadata))
+        return (entries, total_count, cursor)
+
+    def _find(self, query):
         offset = query.pop('offset', 0)
         limit = query.pop('limit', MAX_QUERY_LIMIT)
         order_by = query.pop('order_by', [])
         query_string = query.pop('query', None)
+        cursor = query.pop('cursor', None)
 
-        query_parser = QueryParser()
-        query_parser.set_database(self._database)
-        enquire = Enquire(self._database)
-        enquire.set_query(query_parser.parse_query(query, query_string))
+        try:
+            cache_key = _freeze((query, query_string, order_by, offset,
+                                 limit, cursor))
+            hash(cache_key)
+        except TypeError:
+            cache_key = None
 
-        # This will assure that the results count is exact.
-        check_at_least = offset + limit + 1
+        revision = self._revision
+        cached = self._get_cached_result(cache_key)
+        if cached is not None:
+            return cached
 
         if not order_by:
             order_by = '+timestamp'
         else:
             order_by = order_by[0]
 
-        if order_by == '+timestamp':
-            enquire.set_sort_by_value(_VALUE_TIMESTAMP, True)
-        elif order_by == '-timestamp':
-            enquire.set_sort_by_value(_VALUE_TIMESTAMP, False)
-        elif order_by == '+title':
-            enquire.set_sort_by_value(_VALUE_TITLE, True)
-        elif order_by == '-title':
-            enquire.set_sort_by_value(_VALUE_TITLE, False)
-        elif order_by == '+filesize':
-            enquire.set_sort_by_value(_VALUE_FILESIZE, True)
-        elif order_by == '-filesize':
-            enquire.set_sort_by_value(_VALUE_FILESIZE, False)
-        elif order_by == '+creation_time':
-            enquire.set_sort_by_value(_VALUE_CREATION_TIME, True)
-        elif order_by == '-creation_time':
-            enquire.set_sort_by_value(_VALUE_CREATION_TIME, False)
+        result = self._read(self._query, query, query_string, order_by,
+                            offset, limit, cursor)
+
+        self._cache_result(cache_key, result, revision)
+        return result
+
+    def _query(self, database, query, query_string, order_by, offset, limit,
+               cursor):
+        query_parser = QueryParser()
+        query_parser.set_database(database)
+        enquire = Enquire(database)
+        xapian_query = query_parser.parse_query(query, query_string)
+
+        sort_slot = _SORT_VALUE_MAP.get(order_by[1:], {}).get('number')
+        reverse = order_by.startswith('+')
+        if sort_slot is not None:
+            # Break ties by uid so a cursor designates an exact position
+            sorter = xapian.MultiValueKeyMaker()
+            sorter.add_value(sort_slot, reverse)
+            sorter.add_value(_VALUE_UID, reverse)
+            enquire.set_sort_by_key(sorter, False)
         else:
             logging.warning('Unsupported property for sorting: %s', order_by)
 
+        skipped = 0
+        if cursor:
+            cursor_order_by, value, uid, skipped = _decode_cursor(cursor)
+            if cursor_order_by != order_by:
+                raise ValueError('Cursor was created for order_by %r' %
+                                 cursor_order_by)
+            if sort_slot is not None and value:
+                xapian_query = Query(Query.OP_FILTER, xapian_query,
+                    _parse_cursor(sort_slot, reverse, value, uid))
+                offset = 0
+            else:
+                # entries without a sort value, page by offset
+                offset = skipped
+                skipped = 0
+
+        enquire.set_query(xapian_query)
+
+        # This will assure that the results count is exact.
+        check_at_least = offset + limit + 1
+
         query_result = enquire.get_mset(offset, limit, check_at_least)
-        total_count = query_result.get_matches_estimated()
+        total_count = skipped + query_result.get_matches_estimated()
 
-        uids = []
+        hits = []
+        last_value = ''
         for hit in query_result:
-            uids.append(hit.document.get_value(_VALUE_UID))
-
-        return (uids, total_count)
+            hits.append((hit.document.get_value(_VALUE_UID),
+                         hit.document.get_data()))
+            if sort_slot is not None:
+                last_value = hit.document.get_value(sort_slot)
+
+        position = skipped + offset + len(hits)
+        if hits and position < total_count:
+            next_cursor = _encode_cursor(order_by, last_value, hits[-1][0],
+                                         position)
+        else:
+            next_cursor = ''
+
+        return (hits, total_count, next_cursor)
+
+    def _get_database(self):
+        """Return the database queries of the calling thread should use.
+
+        The main loop uses the writable database. Other threads get their
+        own read-only handles, which only see committed changes and are
+        reopened whenever the index changed.
+        """
+        if threading.current_thread() is self._main_thread:
+            return self._database
+
+        local = self._thread_local
+        # not while the index directories are being swapped
+        with self._swap_lock:
+            if getattr(local, 'generation', None) != self._generation:
+                local.database = self._open_reader()
+                local.generation = self._generation
+                local.revision = self._revision
+            elif local.revision != self._revision:
+                local.revision = self._revision
+                local.database.reopen()
+        return local.database
+
+    def _read(self, function, *args):
+        """Return function(database, *args) for the database of the
+        calling thread.
+
+        Tries again with a fresh handle if the snapshot was overwritten by
+        later commits or the index was replaced meanwhile.
+        """
+        generation = self._generation
+        try:
+            return function(self._get_database(), *args)
+        except xapian.DatabaseError, e:
+            if not isinstance(e, xapian.DatabaseModifiedError) and \
+                    self._generation == generation:
+                raise
+            self._thread_local.revision = None
+            return function(self._get_database(), *args)
+
+    def _open_reader(self):
+        if self._shard_count == 1:
+            return Database(self._index_path)
+
+        database = Database()
+        for number in range(self._shard_count):
+            database.add_database(Database(
+                os.path.join(self._index_path, _get_shard_name(number))))
+        return database
+
+    def commit_pending(self):
+        """Commit buffered changes so other threads can see them."""
+        if self._pending_writes:
+            self._flush(True)
+
+    def _get_cached_result(self, cache_key):
+        with self._cache_lock:
+            if self._query_cache_revision != self._revision:
+                self._query_cache.clear()
+                self._query_cache_revision = self._revision
+
+            if cache_key is None or cache_key not in self._query_cache:
+                self._cache_misses += 1
+                return None
+
+            self._cache_hits += 1
+            result = self._query_cache.pop(cache_key)
+            self._query_cache[cache_key] = result
+            return result
+
+    def _cache_result(self, cache_key, result, revision):
+        with self._cache_lock:
+            if cache_key is None or revision != self._revision:
+                # the index changed while we were querying it
+                return
+            self._query_cache[cache_key] = result
+            while len(self._query_cache) > _QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+
+    def get_cache_stats(self):
+        """Return hit/miss counters of the find() result cache."""
+        return {
+            'hits': self._cache_hits,
+            'misses': self._cache_misses,
+            'entries': len(self._query_cache),
+            'revision': self._revision,
+        }
 
     def delete(self, uid):
-        self._database.delete_document(_PREFIX_FULL_VALUE + _PREFIX_UID + uid)
+        self._revision += 1
+        if self._shadow_shards:
+            self._get_shard(uid, self._shadow_shards).delete_document(
+                _PREFIX_FULL_VALUE + _PREFIX_UID + uid)
+            self._shadow_touched.add(uid)
+        if self._database is None:
+            return
+
+        self._log_intent(_INTENT_DELETE, uid)
+        self._get_shard(uid).delete_document(
+            _PREFIX_FULL_VALUE + _PREFIX_UID + uid)
+        self._flush()
+
+    def delete_entries(self, uids):
+        """Like delete() for a list of uids, committing once."""
+        self._revision += 1
+        if self._shadow_shards:
+            for uid in uids:
+                self._get_shard(uid, self._shadow_shards).delete_document(
+                    _PREFIX_FULL_VALUE + _PREFIX_UID + uid)
+                self._shadow_touched.add(uid)
+        if self._database is None:
+            return
+
+        self._log_intents(_INTENT_DELETE, uids)
+        for uid in uids:
+            self._get_shard(uid).delete_document(
+                _PREFIX_FULL_VALUE + _PREFIX_UID + uid)
         self._flush(True)
 
-    def get_activities(self):
-        activities = []
-        prefix = _PREFIX_FULL_VALUE + _PREFIX_ACTIVITY
-        for term in self._database.allterms(prefix):
-            activities.append(term.term[len(prefix):])
-        return activities
+    def get_facets(self, names, query=None):
+        """Count the entries per value of the given properties.
+
+        Only entries matching query (same format as for find()) are taken
+        into account, if given. Returns a dictionary mapping each property
+        name to a dictionary of values and their counts.
+        """
+        prefixes = {}
+        for name in names:
+            if name not in _FACET_PROPERTIES:
+                raise ValueError('Unsupported facet property %r' % name)
+            prefixes[name] = _QUERY_TERM_MAP[name]
+
+        query = dict(query or {})
+        for key in ['offset', 'limit', 'order_by']:
+            query.pop(key, None)
+        query_string = query.pop('query', None)
+
+        if not query and query_string is None:
+            # every entry matches, so the term frequencies are the counts
+            return dict((name, self._count_terms(prefix))
+                        for name, prefix in prefixes.items())
+
+        query_parser = QueryParser()
+        query_parser.set_database(self._database)
+        enquire = Enquire(self._database)
+        enquire.set_query(query_parser.parse_query(query, query_string))
+        spy = _FacetSpy(prefixes.values())
+        enquire.add_matchspy(spy)
+        enquire.get_mset(0, 0, self._database.get_doccount())
+        return dict((name, spy.counts[prefix])
+                    for name, prefix in prefixes.items())
+
+    def suggest(self, prefix, name='', limit=10):
+        """Return the indexed terms starting with prefix.
+
+        With an empty name, the words of the full text index are
+        enumerated, otherwise the values of the given property (one of
+        those get_facets() supports). Returns up to limit (term, count)
+        tuples, the most frequent terms first. Only committed changes are
+        visible.
+        """
+        if not name:
+            # TermGenerator lowercases the words it indexes, non-ASCII
+            # letters included
+            term_prefix = _PREFIX_NONE
+            if not isinstance(prefix, unicode):
+                prefix = prefix.decode('utf-8', 'replace')
+            prefix = prefix.lower()
+        elif name in _FACET_PROPERTIES:
+            term_prefix = _PREFIX_FULL_VALUE + _QUERY_TERM_MAP[name]
+        else:
+            raise ValueError('Unsupported suggestion property %r' % name)
+        if isinstance(prefix, unicode):
+            prefix = prefix.encode('utf-8')
+
+        cache_key = (term_prefix + prefix, limit)
+        version = (self._generation, self._commits)
+        with self._cache_lock:
+            if self._suggest_cache_version != version:
+                self._suggest_cache.clear()
+                self._suggest_cache_version = version
+            if cache_key in self._suggest_cache:
+                result = self._suggest_cache.pop(cache_key)
+                self._suggest_cache[cache_key] = result
+                return result
+
+        result = self._read(self._suggest, term_prefix, prefix, limit)
+
+        with self._cache_lock:
+            if self._suggest_cache_version == version:
+                self._suggest_cache[cache_key] = result
+                while len(self._suggest_cache) > _SUGGEST_CACHE_SIZE:
+                    self._suggest_cache.popitem(last=False)
+        return result
+
+    def _suggest(self, database, term_prefix, prefix, limit):
+        terms = ((term.termfreq, term.term[len(term_prefix):])
+                 for term in database.allterms(term_prefix + prefix))
+        return [(term, count)
+                for count, term in heapq.nlargest(limit, terms)]
+
+    def _count_terms(self, prefix):
+        counts = {}
+        full_prefix = _PREFIX_FULL_VALUE + prefix
+        for term in self._database.allterms(full_prefix):
+            counts[term.term[len(full_prefix):]] = term.termfreq
+        return counts
 
     def flush(self):
-        self._flush(True)
+        if self._database is not None:
+            self._flush(True)
 
     def get_index_updated(self):
         return os.path.exists(self._index_updated_path)
@@ -386,34 +1374,101 @@ class IndexStore(object):
             else:
                 os.remove(self._index_updated_path)
 
+    def get_pending_intents(self):
+        """Return the uids of changes that never made it into a commit.
+
+        The intent log only survives a commit if the service died before
+        it could flush the pending changes, so the caller is expected to
+        reindex (or drop from the index) every uid returned here.
+        """
+        if not os.path.exists(self._intent_log_path):
+            return []
+
+        uids = []
+        for line in open(self._intent_log_path, 'r'):
+            try:
+                __, uid = line.split()
+            except ValueError:
+                # torn write at the end of the log
+                continue
+            if uid not in uids:
+                uids.append(uid)
+        return uids
+
+    def _log_intent(self, operation, uid):
+        """Durably record a mutation before it is buffered in the index.
+
+        As long as the intent is on disk, the committed index plus the
+        intent log describe the datastore, so the index_updated marker
+        can stay in place between commits.
+        """
+        self._log_intents(operation, [uid])
+
+    def _log_intents(self, operation, uids):
+        if self._std_index_path != self._index_path:
+            # operating from tmpfs, the on-disk index is stale anyway
+            return
+        try:
+            if self._intent_log is None:
+                self._intent_log = open(self._intent_log_path, 'a')
+            for uid in uids:
+                self._intent_log.write('%s %s\n' % (operation, uid))
+            self._intent_log.flush()
+            os.fsync(self._intent_log.fileno())
+        except (IOError, OSError):
+            logging.exception('Could not log index intents for %r', uids)
+            self._set_index_updated(False)
+
+    def _clear_intents(self):
+        if self._intent_log is not None:
+            self._intent_log.close()
+            self._intent_log = None
+        if os.path.exists(self._intent_log_path):
+            os.remove(self._intent_log_path)
+
     def _flush_timeout_cb(self):
+        self._flush_timeout = None
         self._flush(True)
         return False
 
     def _flush(self, force=False):
-        """Called after any database mutation"""
+        """Called after any database mutation.
+
+        Changes are committed as a group: once _FLUSH_THRESHOLD changes or
+        _FLUSH_MAX_BYTES of indexed text are pending, or _FLUSH_TIMEOUT
+        seconds after the first uncommitted change, whichever comes first.
+        """
         logging.debug('IndexStore.flush: force=%r _pending_writes=%r',
                 force, self._pending_writes)
 
-        self._set_index_updated(False)
+        if not force:
+            self._pending_writes += 1
+            if self._pending_writes < _FLUSH_THRESHOLD and \
+                    self._pending_bytes < _FLUSH_MAX_BYTES:
+                if self._flush_timeout is None:
+                    self._flush_timeout = GLib.timeout_add_seconds(
+                        _FLUSH_TIMEOUT, self._flush_timeout_cb)
+                return
 
         if self._flush_timeout is not None:
             GLib.source_remove(self._flush_timeout)
             self._flush_timeout = None
 
-        self._pending_writes += 1
-        if force or self._pending_writes > _FLUSH_THRESHOLD:
-            try:
-                logging.debug("Start database flush")
-                self._database.flush()
-                logging.debug("Completed database flush")
-            except Exception, e:
-                logging.exception(e)
-                logging.error("Exception during database.flush()")
-                # bail out to trigger a reindex
-                sys.exit(1)
-            self._pending_writes = 0
+        try:
+            logging.debug("Start database flush")
+            for shard in self._shards:
+                shard.flush()
+            logging.debug("Completed database flush")
+        except Exception, e:
+            logging.exception(e)
+            logging.error("Exception during database.flush()")
+            # bail out to trigger a reindex
+            sys.exit(1)
+        self._pending_writes = 0
+        self._pending_bytes = 0
+        # let read threads pick up the commit
+        self._revision += 1
+        self._commits += 1
+        if not self._shadow_shards:
             self._set_index_updated(True)
-        else:
-            self._flush_timeout = GLib.timeout_add_seconds(
-                _FLUSH_TIMEOUT, self._flush_timeout_cb)
+        self._clear_intents()
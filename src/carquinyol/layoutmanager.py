@@ -20,7 +20,8 @@ import logging
 from sugar3 import env
 
 MAX_QUERY_LIMIT = 40960
-CURRENT_LAYOUT_VERSION = 6
+CURRENT_LAYOUT_VERSION = 7
+DEFAULT_METADATA_BACKEND = 'packed'
 
 
 class LayoutManager(object):
@@ -57,6 +58,22 @@ class LayoutManager(object):
         version_path = os.path.join(self._root_path, 'version')
         open(version_path, 'w').write(str(version))
 
+    def get_metadata_backend(self):
+        """Return the name of the MetadataStore backend in use."""
+        backend_path = os.path.join(self._root_path, 'metadata_backend')
+        if os.path.exists(backend_path):
+            return open(backend_path, 'r').read().strip()
+        return DEFAULT_METADATA_BACKEND
+
+    def set_metadata_backend(self, backend):
+        backend_path = os.path.join(self._root_path, 'metadata_backend')
+        tmp_path = backend_path + '.tmp'
+        f = open(tmp_path, 'w')
+        f.write(backend)
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmp_path, backend_path)
+
     def get_entry_path(self, uid):
         # os.path.join() is just too slow
         return '%s/%s/%s' % (self._root_path, uid[:2], uid)
@@ -65,14 +82,31 @@ class LayoutManager(object):
         return '%s/%s/%s/data' % (self._root_path, uid[:2], uid)
 
     def get_metadata_path(self, uid):
+        """Return the metadata directory of an entry (layout version 6 and
+        earlier, one file per property)."""
         return '%s/%s/%s/metadata' % (self._root_path, uid[:2], uid)
 
+    def get_metadata_file_path(self, uid):
+        return '%s/%s/%s/metadata.pack' % (self._root_path, uid[:2], uid)
+
+    def get_external_property_path(self, uid, name):
+        return '%s/%s/%s/%s' % (self._root_path, uid[:2], uid, name)
+
+    def get_metadata_db_path(self):
+        return os.path.join(self._root_path, 'metadata.db')
+
     def get_root_path(self):
         return self._root_path
 
     def get_index_path(self):
         return os.path.join(self._root_path, 'index')
 
+    def get_shadow_index_path(self):
+        return os.path.join(self._root_path, 'index.shadow')
+
+    def get_compacted_index_path(self):
+        return os.path.join(self._root_path, 'index.compact')
+
     def get_checksums_dir(self):
         return os.path.join(self._root_path, 'checksums')
 
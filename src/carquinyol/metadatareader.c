@@ -1,10 +1,19 @@
 #include "Python.h"
 
 #include <dirent.h>
+#include <fcntl.h>
+#include <unistd.h>
 
 // TODO: put it in a place where python can use it when writing metadata
 #define MAX_PROPERTY_LENGTH 500 * 1024
 
+// Packed metadata files (layout version 7), see metadatastore.py
+#define PACKED_MAGIC "SDM1"
+#define PACKED_MAGIC_LENGTH 4
+#define PACKED_HEADER_LENGTH 7
+#define PACKED_FLAG_EXTERNAL 1
+#define MAX_PACKED_LENGTH 16 * 1024 * 1024
+
 static PyObject *byte_array_type = NULL;
 
 int
@@ -203,11 +212,521 @@ static PyObject *metadatareader_retrieve (PyObject * unused, PyObject * args) {
     return dict;
 }
 
+/* Read a whole file into a malloc()ed buffer.
+ *
+ * Does not use the Python API, so it can run without holding the GIL.
+ * Returns 0 or an errno value.
+ */
+static int read_whole_file (const char *file_path, char **buf, long *size) {
+    int fd;
+    int error = 0;
+    struct stat file_stat;
+    long done = 0;
+
+    *buf = NULL;
+    fd = open (file_path, O_RDONLY);
+    if (fd < 0)
+        return errno;
+
+    if (fstat (fd, &file_stat) != 0) {
+        error = errno;
+        goto cleanup;
+    }
+
+    if (file_stat.st_size > MAX_PACKED_LENGTH) {
+        error = EFBIG;
+        goto cleanup;
+    }
+
+    *size = file_stat.st_size;
+    *buf = malloc (*size + 1);
+    if (*buf == NULL) {
+        error = ENOMEM;
+        goto cleanup;
+    }
+
+    while (done < *size) {
+        ssize_t read_size = read (fd, *buf + done, *size - done);
+        if (read_size < 0 && errno == EINTR)
+            continue;
+        if (read_size <= 0) {
+            error = read_size < 0 ? errno : EIO;
+            free (*buf);
+            *buf = NULL;
+            goto cleanup;
+        }
+        done += read_size;
+    }
+
+  cleanup:
+    close (fd);
+    return error;
+}
+
+static void set_read_error (const char *file_path, int error) {
+    if (error == ENOMEM) {
+        PyErr_NoMemory ();
+    } else if (error == EFBIG) {
+        PyErr_SetString (PyExc_ValueError, "Metadata file too big");
+    } else if (error == EBADMSG) {
+        PyErr_Format (PyExc_ValueError, "Truncated metadata file %s",
+                file_path);
+    } else {
+        errno = error;
+        PyErr_SetFromErrnoWithFilename (PyExc_IOError, (char *) file_path);
+    }
+}
+
+/* A packed metadata file and the external property files it refers to,
+ * as read without holding the GIL.
+ */
+typedef struct {
+    const char *file_path;
+    char *buf;
+    long size;
+    int error;
+    // one per wanted external property, in the order of the records
+    int external_count;
+    char **external_bufs;
+    long *external_sizes;
+    int *external_errors;
+} packed_file;
+
+/* Return 1 if key is one of the count names, or if names is NULL.
+ */
+static int is_wanted (const char *key, unsigned long key_length,
+        char **names, Py_ssize_t count) {
+    Py_ssize_t i;
+
+    if (names == NULL)
+        return 1;
+    for (i = 0; i < count; i++) {
+        if (strlen (names[i]) == key_length &&
+                memcmp (names[i], key, key_length) == 0)
+            return 1;
+    }
+    return 0;
+}
+
+/* Walk the records of a packed file, calling record_cb for each of them.
+ *
+ * Stops at the first call returning 0. Returns -1 if the file is
+ * truncated, 0 if record_cb stopped it, 1 otherwise.
+ */
+typedef int (*record_callback) (const char *key, unsigned long key_length,
+        int flags, const char *value, unsigned long value_length,
+        void *user_data);
+
+static int walk_packed (const char *buf, long size, record_callback record_cb,
+        void *user_data) {
+    long pos = PACKED_MAGIC_LENGTH;
+
+    while (pos < size) {
+        const unsigned char *header = (const unsigned char *) buf + pos;
+        unsigned long key_length, value_length;
+        int flags;
+
+        if (size - pos < PACKED_HEADER_LENGTH)
+            return -1;
+
+        key_length = (header[0] << 8) | header[1];
+        flags = header[2];
+        value_length = ((unsigned long) header[3] << 24) |
+            (header[4] << 16) | (header[5] << 8) | header[6];
+        pos += PACKED_HEADER_LENGTH;
+
+        if (key_length > (unsigned long) (size - pos) ||
+                value_length > (unsigned long) (size - pos) - key_length)
+            return -1;
+
+        if (!record_cb (buf + pos, key_length, flags, buf + pos + key_length,
+                        value_length, user_data))
+            return 0;
+        pos += key_length + value_length;
+    }
+    return 1;
+}
+
+typedef struct {
+    packed_file *file;
+    char **names;
+    Py_ssize_t name_count;
+    char *path;
+    size_t dir_length;
+} external_reader;
+
+static int count_external_cb (const char *key, unsigned long key_length,
+        int flags, const char *value, unsigned long value_length,
+        void *user_data) {
+    external_reader *reader = user_data;
+
+    if ((flags & PACKED_FLAG_EXTERNAL) &&
+            is_wanted (key, key_length, reader->names, reader->name_count))
+        reader->file->external_count++;
+    return 1;
+}
+
+static int read_external_cb (const char *key, unsigned long key_length,
+        int flags, const char *value, unsigned long value_length,
+        void *user_data) {
+    external_reader *reader = user_data;
+    packed_file *file = reader->file;
+    int i = file->external_count;
+
+    if (!(flags & PACKED_FLAG_EXTERNAL) ||
+            !is_wanted (key, key_length, reader->names, reader->name_count))
+        return 1;
+
+    // External properties live in the entry directory
+    memcpy (reader->path + reader->dir_length, key, key_length);
+    reader->path[reader->dir_length + key_length] = '\0';
+    file->external_errors[i] = read_whole_file (reader->path,
+            &file->external_bufs[i], &file->external_sizes[i]);
+    file->external_count++;
+    return 1;
+}
+
+/* Read a packed file and the wanted external property files it lists.
+ *
+ * Does not use the Python API, so it can run without holding the GIL.
+ * names is NULL if all properties are wanted. Errors are left in file.
+ */
+static void read_packed_file (packed_file * file, char **names,
+        Py_ssize_t name_count) {
+    external_reader reader;
+    const char *slash;
+    int count;
+
+    file->buf = NULL;
+    file->external_count = 0;
+    file->external_bufs = NULL;
+    file->external_sizes = NULL;
+    file->external_errors = NULL;
+
+    file->error = read_whole_file (file->file_path, &file->buf, &file->size);
+    if (file->error != 0)
+        return;
+    if (file->size < PACKED_MAGIC_LENGTH ||
+            memcmp (file->buf, PACKED_MAGIC, PACKED_MAGIC_LENGTH) != 0)
+        // reported by parse_packed()
+        return;
+
+    reader.file = file;
+    reader.names = names;
+    reader.name_count = name_count;
+    if (walk_packed (file->buf, file->size, count_external_cb, &reader) < 0) {
+        // no external record may be read without the arrays below
+        file->external_count = 0;
+        file->error = EBADMSG;
+        return;
+    }
+    if (file->external_count == 0)
+        return;
+
+    count = file->external_count;
+    file->external_count = 0;
+    slash = strrchr (file->file_path, '/');
+    reader.dir_length = slash == NULL ? 0 : slash - file->file_path + 1;
+    // keys are at most 0xffff bytes long
+    reader.path = malloc (reader.dir_length + 0x10000);
+    file->external_bufs = calloc (count, sizeof (char *));
+    file->external_sizes = calloc (count, sizeof (long));
+    file->external_errors = calloc (count, sizeof (int));
+    if (reader.path == NULL || file->external_bufs == NULL ||
+            file->external_sizes == NULL || file->external_errors == NULL) {
+        file->error = ENOMEM;
+    } else {
+        memcpy (reader.path, file->file_path, reader.dir_length);
+        walk_packed (file->buf, file->size, read_external_cb, &reader);
+    }
+    free (reader.path);
+}
+
+static void free_packed_file (packed_file * file) {
+    int i;
+
+    free (file->buf);
+    file->buf = NULL;
+    if (file->external_bufs != NULL) {
+        for (i = 0; i < file->external_count; i++)
+            free (file->external_bufs[i]);
+    }
+    free (file->external_bufs);
+    free (file->external_sizes);
+    free (file->external_errors);
+    file->external_bufs = NULL;
+    file->external_sizes = NULL;
+    file->external_errors = NULL;
+    file->external_count = 0;
+}
+
+static PyObject *new_value (const char *buf, long size) {
+    PyObject *args;
+    PyObject *value;
+
+    if (size == 0)
+        return PyString_FromString ("");
+
+    args = Py_BuildValue ("(s#)", buf, (int) size);
+    if (args == NULL)
+        return NULL;
+    value = PyObject_CallObject (byte_array_type, args);
+    Py_DECREF (args);
+    return value;
+}
+
+typedef struct {
+    packed_file *file;
+    char **names;
+    Py_ssize_t name_count;
+    PyObject *dict;
+    int external;
+} packed_parser;
+
+static int parse_record_cb (const char *key_buf, unsigned long key_length,
+        int flags, const char *value_buf, unsigned long value_length,
+        void *user_data) {
+    packed_parser *parser = user_data;
+    packed_file *file = parser->file;
+    PyObject *key = NULL;
+    PyObject *value = NULL;
+    int i;
+
+    if (!is_wanted (key_buf, key_length, parser->names, parser->name_count))
+        return 1;
+
+    if (flags & PACKED_FLAG_EXTERNAL) {
+        i = parser->external++;
+        if (file->external_errors == NULL || i >= file->external_count) {
+            // read_packed_file() did not get to read it
+            set_read_error (file->file_path, EBADMSG);
+            return 0;
+        }
+        if (file->external_errors[i] == ENOENT) {
+            // a property without a value
+            return 1;
+        } else if (file->external_errors[i] != 0) {
+            set_read_error (file->file_path, file->external_errors[i]);
+            return 0;
+        }
+        value = new_value (file->external_bufs[i], file->external_sizes[i]);
+    } else {
+        value = new_value (value_buf, value_length);
+    }
+    if (value == NULL)
+        return 0;
+
+    // Interned, so that the dicts of many entries share their keys
+    key = PyString_FromStringAndSize (key_buf, key_length);
+    if (key == NULL)
+        goto error;
+    PyString_InternInPlace (&key);
+
+    if (PyDict_SetItem (parser->dict, key, value) == -1)
+        goto error;
+    Py_DECREF (key);
+    Py_DECREF (value);
+    return 1;
+
+  error:
+    Py_XDECREF (key);
+    Py_DECREF (value);
+    return 0;
+}
+
+/* Turn a file read by read_packed_file() into a dictionary.
+ */
+static PyObject *parse_packed (packed_file * file, char **names,
+        Py_ssize_t name_count) {
+    packed_parser parser;
+    int result;
+
+    if (file->error != 0) {
+        set_read_error (file->file_path, file->error);
+        return NULL;
+    }
+
+    if (file->size < PACKED_MAGIC_LENGTH ||
+            memcmp (file->buf, PACKED_MAGIC, PACKED_MAGIC_LENGTH) != 0) {
+        PyErr_Format (PyExc_ValueError, "Invalid metadata file %s",
+                file->file_path);
+        return NULL;
+    }
+
+    parser.file = file;
+    parser.names = names;
+    parser.name_count = name_count;
+    parser.external = 0;
+    parser.dict = PyDict_New ();
+    if (parser.dict == NULL)
+        return NULL;
+
+    result = walk_packed (file->buf, file->size, parse_record_cb, &parser);
+    if (result < 0)
+        PyErr_Format (PyExc_ValueError, "Truncated metadata file %s",
+                file->file_path);
+    if (result <= 0) {
+        Py_DECREF (parser.dict);
+        return NULL;
+    }
+    return parser.dict;
+}
+
+/* Return the names in properties as C strings, in *names, or NULL if all
+ * properties are wanted.
+ *
+ * The strings belong to the list, which must be kept alive.
+ */
+static int get_names (PyObject * properties, char ***names,
+        Py_ssize_t * count) {
+    Py_ssize_t i;
+
+    *names = NULL;
+    *count = 0;
+    if (properties == Py_None)
+        return 1;
+
+    if (!PyList_Check (properties)) {
+        PyErr_SetString (PyExc_TypeError, "properties must be a list");
+        return 0;
+    }
+    if (PyList_Size (properties) == 0)
+        return 1;
+
+    *count = PyList_Size (properties);
+    *names = PyMem_Malloc (*count * sizeof (char *));
+    if (*names == NULL) {
+        PyErr_NoMemory ();
+        return 0;
+    }
+    for (i = 0; i < *count; i++) {
+        (*names)[i] = PyString_AsString (PyList_GET_ITEM (properties, i));
+        if ((*names)[i] == NULL) {
+            PyMem_Free (*names);
+            *names = NULL;
+            return 0;
+        }
+    }
+    return 1;
+}
+
+static PyObject *metadatareader_retrieve_packed (PyObject * unused,
+        PyObject * args) {
+    PyObject *dict = NULL;
+    PyObject *properties = NULL;
+    packed_file file;
+    char **names;
+    Py_ssize_t name_count;
+
+    if (!PyArg_ParseTuple (args, "sO:retrieve_packed", &file.file_path,
+                    &properties))
+        return NULL;
+
+    if (!get_names (properties, &names, &name_count))
+        return NULL;
+
+    Py_BEGIN_ALLOW_THREADS
+    read_packed_file (&file, names, name_count);
+    Py_END_ALLOW_THREADS
+
+    dict = parse_packed (&file, names, name_count);
+    free_packed_file (&file);
+    PyMem_Free (names);
+    return dict;
+}
+
+static PyObject *metadatareader_retrieve_many (PyObject * unused,
+        PyObject * args) {
+    PyObject *paths = NULL;
+    PyObject *properties = NULL;
+    PyObject *result = NULL;
+    packed_file *files = NULL;
+    char **names = NULL;
+    Py_ssize_t name_count;
+    Py_ssize_t count, i;
+
+    if (!PyArg_ParseTuple (args, "OO:retrieve_many", &paths, &properties))
+        return NULL;
+
+    if (!PyList_Check (paths)) {
+        PyErr_SetString (PyExc_TypeError, "paths must be a list");
+        return NULL;
+    }
+    if (!get_names (properties, &names, &name_count))
+        return NULL;
+
+    count = PyList_Size (paths);
+    files = PyMem_Malloc ((count + 1) * sizeof (packed_file));
+    if (files == NULL) {
+        PyErr_NoMemory ();
+        count = 0;
+        goto cleanup;
+    }
+    for (i = 0; i < count; i++) {
+        // the list keeps the strings alive while the GIL is released
+        files[i].file_path = PyString_AsString (PyList_GET_ITEM (paths, i));
+        if (files[i].file_path == NULL) {
+            count = 0;
+            goto cleanup;
+        }
+    }
+
+    // Do all the I/O at once, letting other threads run meanwhile
+    Py_BEGIN_ALLOW_THREADS
+    for (i = 0; i < count; i++)
+        read_packed_file (&files[i], names, name_count);
+    Py_END_ALLOW_THREADS
+
+    result = PyList_New (count);
+    if (result == NULL)
+        goto cleanup;
+
+    for (i = 0; i < count; i++) {
+        PyObject *dict;
+
+        if (files[i].error == ENOENT) {
+            // entry deleted meanwhile, let the caller decide
+            Py_INCREF (Py_None);
+            PyList_SET_ITEM (result, i, Py_None);
+            continue;
+        }
+
+        dict = parse_packed (&files[i], names, name_count);
+        if (dict == NULL)
+            goto error;
+        PyList_SET_ITEM (result, i, dict);
+    }
+    goto cleanup;
+
+  error:
+    Py_DECREF (result);
+    result = NULL;
+
+  cleanup:
+    if (files) {
+        for (i = 0; i < count; i++)
+            free_packed_file (&files[i]);
+        PyMem_Free (files);
+    }
+    if (names) {
+        PyMem_Free (names);
+    }
+    return result;
+}
+
 static PyMethodDef metadatareader_functions[] = {
     {"retrieve", metadatareader_retrieve, METH_VARARGS,
             PyDoc_STR
                 ("Read a dictionary from a directory with a single file "
                         "(containing the content) per key")},
+    {"retrieve_packed", metadatareader_retrieve_packed, METH_VARARGS,
+            PyDoc_STR
+                ("Read a dictionary from a packed metadata file, "
+                        "optionally only the given keys")},
+    {"retrieve_many", metadatareader_retrieve_many, METH_VARARGS,
+            PyDoc_STR
+                ("Read a list of packed metadata files at once, returning "
+                        "a list of dictionaries (None for missing files)")},
     {NULL, NULL, 0, NULL}
 };
 
@@ -1,4 +1,13 @@
+import collections
+import errno
+import hashlib
 import os
+import sqlite3
+import struct
+import tempfile
+import threading
+
+import dbus
 
 from carquinyol import layoutmanager
 from carquinyol import metadatareader
@@ -6,72 +15,814 @@ from carquinyol import metadatareader
 MAX_SIZE = 256
 _INTERNAL_KEYS = ['checksum']
 
+# The metadata of an entry is a single file: _PACKED_MAGIC followed by one
+# record per property, made of a _RECORD_HEADER (key length, flags, value
+# length) and the key and value bytes. metadatareader.c reads it.
+_PACKED_MAGIC = 'SDM1'
+_RECORD_HEADER = struct.Struct('!HBI')
+_FLAG_EXTERNAL = 1
 
-class MetadataStore(object):
+# Properties kept in a file of their own in the entry directory, so that
+# the packed file stays small; the record only has the flag set.
+_EXTERNAL_PROPERTIES = ['preview']
+
+# Default bounds of the retrieve() cache
+CACHE_MAX_ENTRIES = 1000
+CACHE_MAX_BYTES = 4 * 1024 * 1024
+
+# Number of files PackedBackend remembers the last written contents of
+_MANIFEST_SIZE = 1000
+
+# How long an SQLite connection waits for another one to finish writing
+_SQLITE_TIMEOUT = 30
+
+# Maximum number of uids per SQLite query, below SQLITE_MAX_VARIABLE_NUMBER
+_SQLITE_BATCH_SIZE = 500
+
+
+def pack_metadata(metadata):
+    """Return the packed file contents for a dictionary of str values.
+
+    Properties listed in _EXTERNAL_PROPERTIES only get an empty record.
+    """
+    chunks = [_PACKED_MAGIC]
+    for key, value in metadata.items():
+        if key in _EXTERNAL_PROPERTIES:
+            chunks.append(_RECORD_HEADER.pack(len(key), _FLAG_EXTERNAL, 0))
+            chunks.append(key)
+        else:
+            chunks.append(_RECORD_HEADER.pack(len(key), 0, len(value)))
+            chunks.append(key)
+            chunks.append(value)
+    return ''.join(chunks)
+
+
+def unpack_metadata(data):
+    """Return a key -> value dictionary, None meaning external, for the
+    contents of a packed file."""
+    if not data.startswith(_PACKED_MAGIC):
+        raise ValueError('Invalid metadata file')
+
+    metadata = {}
+    pos = len(_PACKED_MAGIC)
+    while pos < len(data):
+        key_length, flags, value_length = \
+                _RECORD_HEADER.unpack_from(data, pos)
+        pos += _RECORD_HEADER.size
+        key = data[pos:pos + key_length]
+        pos += key_length
+        if flags & _FLAG_EXTERNAL:
+            metadata[key] = None
+        else:
+            metadata[key] = data[pos:pos + value_length]
+        pos += value_length
+    if pos != len(data):
+        raise ValueError('Truncated metadata file')
+    return metadata
+
+
+def _to_str(value):
+    # FIXME: this codepath handles raw image data
+    # str() is 8-bit clean right now, but
+    # this won't last. We will need more explicit
+    # handling of strings, int/floats vs raw data
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif not isinstance(value, basestring):
+        return str(value)
+    return value
+
+
+def _normalize_key(key):
+    # Hack to support activities that still pass properties named as
+    # for example title:text.
+    if ':' in key:
+        key = key.split(':', 1)[0]
+    return str(key)
+
+
+def _normalize(uid, metadata):
+    """Return a copy of metadata with str keys and values."""
+    normalized = {}
+    for key, value in metadata.items():
+        normalized[_normalize_key(key)] = _to_str(value)
+    normalized['uid'] = uid
+    return normalized
+
+
+def _get_size(metadata):
+    return sum(len(key) + len(value) for key, value in metadata.items())
+
+
+class PackedBackend(object):
+    """Keep the metadata of each entry in a packed file in its directory.
+
+    Writes are coalesced: a manifest remembers what was last written to
+    each file, so unchanged files are neither read back for comparison
+    nor rewritten. The files of a batch are written and flushed first,
+    then renamed into place, and each directory involved is synced once.
+    Only the main loop writes, so the manifest needs no locking.
+    """
+
+    name = 'packed'
+
+    def __init__(self):
+        # path -> (signature, digest, contents or None)
+        self._manifest = collections.OrderedDict()
+        self._syscalls = collections.defaultdict(int)
 
     def store(self, uid, metadata):
-        metadata_path = layoutmanager.get_instance().get_metadata_path(uid)
-        if not os.path.exists(metadata_path):
-            os.makedirs(metadata_path)
+        self.store_many([(uid, metadata)])
+
+    def store_many(self, entries):
+        writes = []
+        for uid, metadata in entries:
+            writes.extend(self._diff(uid, metadata))
+        self._write(writes)
+
+    def _diff(self, uid, metadata):
+        """Return the (path, contents, keep) tuples to write for an entry.
+        """
+        layout_manager = layoutmanager.get_instance()
+        metadata_path = layout_manager.get_metadata_file_path(uid)
+        __, old_data = self._read(metadata_path, keep=True)
+        if old_data is not None:
+            old_metadata = unpack_metadata(old_data)
         else:
-            received_keys = metadata.keys()
-            for key in os.listdir(metadata_path):
-                if key not in _INTERNAL_KEYS and key not in received_keys:
-                    os.remove(os.path.join(metadata_path, key))
+            old_metadata = {}
 
-        metadata['uid'] = uid
-        for key, value in metadata.items():
-            self._set_property(uid, key, value, md_path=metadata_path)
-
-    def _set_property(self, uid, key, value, md_path=False):
-        if not md_path:
-            md_path = layoutmanager.get_instance().get_metadata_path(uid)
-        # Hack to support activities that still pass properties named as
-            # for example title:text.
-        if ':' in key:
-            key = key.split(':', 1)[0]
-
-        changed = True
-        fpath = os.path.join(md_path, key)
-        tpath = os.path.join(md_path, '.' + key)
-        # FIXME: this codepath handles raw image data
-        # str() is 8-bit clean right now, but
-        # this won't last. We will need more explicit
-        # handling of strings, int/floats vs raw data
-        if isinstance(value, unicode):
-            value = value.encode('utf-8')
-        elif not isinstance(value, basestring):
-            value = str(value)
-
-        # avoid pointless writes; replace atomically
-        if os.path.exists(fpath):
-            stored_val = open(fpath, 'r').read()
-
-            if stored_val == value:
-                changed = False
-        if changed:
-            f = open(tpath, 'w')
-            f.write(value)
+        for key in _INTERNAL_KEYS:
+            if key in old_metadata and key not in metadata:
+                metadata[key] = old_metadata[key]
+
+        writes = []
+        for key in _EXTERNAL_PROPERTIES:
+            path = layout_manager.get_external_property_path(uid, key)
+            if key in metadata:
+                if key not in old_metadata or self._read(path)[0] != \
+                        hashlib.sha1(metadata[key]).digest():
+                    writes.append((path, metadata[key], False))
+            elif key in old_metadata:
+                self._unlink(path)
+
+        data = pack_metadata(metadata)
+        if data != old_data:
+            writes.append((metadata_path, data, True))
+        return writes
+
+    def _read(self, path, keep=False):
+        """Return (digest, contents) of a file, (None, None) if it does not
+        exist. Contents are only returned if keep is True.
+
+        Files that did not change since we wrote them are not read.
+        """
+        item = self._manifest.get(path)
+        if item is not None:
+            try:
+                signature = self._stat(path)
+            except OSError:
+                signature = None
+            if signature == item[0] and (item[2] is not None or not keep):
+                return item[1], item[2]
+
+        self._syscalls['open'] += 1
+        try:
+            f = open(path, 'r')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None, None
+            raise
+        try:
+            self._syscalls['read'] += 1
+            data = f.read()
+        finally:
+            self._syscalls['close'] += 1
             f.close()
-            os.rename(tpath, fpath)
+        return hashlib.sha1(data).digest(), data
+
+    def _write(self, writes):
+        """Replace the contents of files, flushing them in one batch.
+
+        The manifest remembers the contents of files written with keep set,
+        and only a digest of the others.
+        """
+        renames = []
+        for path, data, keep in writes:
+            directory, name = os.path.split(path)
+            tmp_path = os.path.join(directory, '.' + name)
+            self._syscalls['open'] += 1
+            f = open(tmp_path, 'w')
+            try:
+                self._syscalls['write'] += 1
+                f.write(data)
+                f.flush()
+                self._syscalls['fdatasync'] += 1
+                os.fdatasync(f.fileno())
+                # rename() keeps inode, mtime and size
+                self._syscalls['fstat'] += 1
+                stat = os.fstat(f.fileno())
+            finally:
+                self._syscalls['close'] += 1
+                f.close()
+            signature = stat.st_ino, stat.st_mtime, stat.st_size
+            digest = hashlib.sha1(data).digest()
+            if not keep:
+                data = None
+            renames.append((tmp_path, path, signature, digest, data))
+
+        directories = set()
+        for tmp_path, path, signature, digest, contents in renames:
+            self._syscalls['rename'] += 1
+            os.rename(tmp_path, path)
+            directories.add(os.path.dirname(path))
+            self._remember(path, (signature, digest, contents))
+
+        for directory in directories:
+            self._syscalls['open'] += 1
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                self._syscalls['fsync'] += 1
+                os.fsync(fd)
+            finally:
+                self._syscalls['close'] += 1
+                os.close(fd)
+
+    def _remember(self, path, item):
+        self._manifest.pop(path, None)
+        self._manifest[path] = item
+        while len(self._manifest) > _MANIFEST_SIZE:
+            self._manifest.popitem(last=False)
+
+    def _stat(self, path):
+        self._syscalls['stat'] += 1
+        stat = os.stat(path)
+        return stat.st_ino, stat.st_mtime, stat.st_size
+
+    def _unlink(self, path):
+        self._manifest.pop(path, None)
+        self._syscalls['unlink'] += 1
+        os.remove(path)
+
+    def get_syscall_counts(self):
+        """Return the number of system calls made to write metadata."""
+        return dict(self._syscalls)
+
+    def set_property(self, uid, key, value):
+        layout_manager = layoutmanager.get_instance()
+        metadata_path = layout_manager.get_metadata_file_path(uid)
+        __, data = self._read(metadata_path, keep=True)
+        if data is None:
+            raise IOError(errno.ENOENT, 'No metadata for entry', uid)
+        metadata = unpack_metadata(data)
+        writes = []
+        if key in _EXTERNAL_PROPERTIES:
+            writes.append((layout_manager.get_external_property_path(uid, key),
+                           value, False))
+        metadata[key] = value
+        writes.append((metadata_path, pack_metadata(metadata), True))
+        self._write(writes)
+
+    def retrieve(self, uid, properties):
+        metadata_path = \
+                layoutmanager.get_instance().get_metadata_file_path(uid)
+        return metadatareader.retrieve_packed(metadata_path, properties)
+
+    def retrieve_many(self, uids, properties):
+        layout_manager = layoutmanager.get_instance()
+        return metadatareader.retrieve_many(
+            [layout_manager.get_metadata_file_path(uid) for uid in uids],
+            properties)
+
+    def update(self, uid, changed, removed):
+        """Set and remove some properties of an entry.
+
+        Returns the resulting metadata, without the values of properties
+        kept in files of their own, and the names of the properties that
+        actually changed.
+        """
+        layout_manager = layoutmanager.get_instance()
+        metadata_path = layout_manager.get_metadata_file_path(uid)
+        __, data = self._read(metadata_path, keep=True)
+        if data is None:
+            raise IOError(errno.ENOENT, 'No metadata for entry', uid)
+        metadata = unpack_metadata(data)
+
+        modified = []
+        writes = []
+        for key, value in changed.items():
+            if key in _EXTERNAL_PROPERTIES:
+                path = layout_manager.get_external_property_path(uid, key)
+                if key in metadata and self._read(path)[0] == \
+                        hashlib.sha1(value).digest():
+                    continue
+                writes.append((path, value, False))
+                metadata[key] = None
+            elif metadata.get(key) == value:
+                continue
+            else:
+                metadata[key] = value
+            modified.append(key)
+
+        for key in removed:
+            if key not in metadata or key == 'uid':
+                continue
+            if key in _EXTERNAL_PROPERTIES:
+                self._unlink(
+                    layout_manager.get_external_property_path(uid, key))
+            del metadata[key]
+            modified.append(key)
+
+        new_data = pack_metadata(metadata)
+        if new_data != data:
+            writes.append((metadata_path, new_data, True))
+        self._write(writes)
+
+        return dict((key, value) for key, value in metadata.items()
+                    if value is not None), modified
+
+    def contains(self, uid):
+        return os.path.exists(
+            layoutmanager.get_instance().get_metadata_file_path(uid))
+
+    def open_property(self, uid, key):
+        """Return a file holding the value of a property, if it is stored
+        in a file of its own, else None."""
+        if key not in _EXTERNAL_PROPERTIES:
+            return None
+        path = layoutmanager.get_instance().get_external_property_path(uid,
+                                                                       key)
+        try:
+            return open(path, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def delete(self, uid):
+        layout_manager = layoutmanager.get_instance()
+        for key in _EXTERNAL_PROPERTIES:
+            path = layout_manager.get_external_property_path(uid, key)
+            if os.path.exists(path):
+                self._unlink(path)
+        self._unlink(layout_manager.get_metadata_file_path(uid))
+
+    def get_signature(self, uid, metadata):
+        """Return what tells whether the files metadata was read from
+        changed.
+
+        Files are always replaced by rename(), so a new inode, mtime or
+        size means new contents. The first item only depends on the
+        metadata file, so it can be taken before reading. Raises OSError
+        if a file is gone.
+        """
+        layout_manager = layoutmanager.get_instance()
+        paths = [layout_manager.get_metadata_file_path(uid)]
+        for key in _EXTERNAL_PROPERTIES:
+            if key in metadata:
+                paths.append(
+                    layout_manager.get_external_property_path(uid, key))
+        signature = []
+        for path in paths:
+            stat = os.stat(path)
+            signature.append((stat.st_ino, stat.st_mtime, stat.st_size))
+        return signature
+
+    def destroy(self):
+        """Remove the metadata of all entries."""
+        for uid in layoutmanager.get_instance().find_all():
+            if self.contains(uid):
+                self.delete(uid)
+
+
+class SqliteBackend(object):
+    """Keep the metadata of all entries in a single SQLite database.
+
+    The database runs in WAL mode, so readers do not block the writer.
+    Every thread gets a connection of its own. Every write gives the entry
+    a new random version, which tells cached results apart from current
+    ones, whichever process wrote.
+    """
+
+    name = 'sqlite'
+
+    def __init__(self):
+        self._path = layoutmanager.get_instance().get_metadata_db_path()
+        self._thread_local = threading.local()
+
+    def _get_connection(self):
+        connection = getattr(self._thread_local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=_SQLITE_TIMEOUT)
+            connection.text_factory = str
+            connection.execute('PRAGMA journal_mode=WAL')
+            # a commit only reaches the disk at the next checkpoint, but
+            # the database cannot get corrupted
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS metadata ('
+                               'uid TEXT, key TEXT, value BLOB, '
+                               'PRIMARY KEY (uid, key))')
+            if connection.execute("SELECT 1 FROM sqlite_master WHERE "
+                                  "name = 'versions'").fetchone() is None:
+                # databases created before versions were kept
+                with connection:
+                    connection.execute('CREATE TABLE IF NOT EXISTS versions '
+                                       '(uid TEXT PRIMARY KEY, version '
+                                       'INTEGER)')
+                    connection.execute('INSERT OR IGNORE INTO versions '
+                                       'SELECT DISTINCT uid, random() '
+                                       'FROM metadata')
+            self._thread_local.connection = connection
+        return connection
+
+    def store(self, uid, metadata):
+        self.store_many([(uid, metadata)])
+
+    def store_many(self, entries):
+        """Store the metadata of several entries in a single transaction.
+        """
+        connection = self._get_connection()
+        with connection:
+            for uid, metadata in entries:
+                self._store(connection, uid, metadata)
+
+    def _store(self, connection, uid, metadata):
+        keys = [key for key in _INTERNAL_KEYS if key not in metadata]
+        if keys:
+            cursor = connection.execute(
+                'SELECT key, value FROM metadata WHERE uid = ? AND key IN '
+                '(%s)' % ', '.join('?' * len(keys)), [uid] + keys)
+            for key, value in cursor:
+                metadata[key] = str(value)
+
+        connection.execute('DELETE FROM metadata WHERE uid = ?', (uid, ))
+        connection.executemany(
+            'INSERT INTO metadata (uid, key, value) VALUES (?, ?, ?)',
+            [(uid, key, sqlite3.Binary(value))
+             for key, value in metadata.items()])
+        self._bump_version(connection, uid)
+
+    def _bump_version(self, connection, uid):
+        connection.execute('INSERT OR REPLACE INTO versions (uid, version) '
+                           'VALUES (?, random())', (uid, ))
+
+    def set_property(self, uid, key, value):
+        connection = self._get_connection()
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO metadata (uid, key, value) '
+                'VALUES (?, ?, ?)', (uid, key, sqlite3.Binary(value)))
+            self._bump_version(connection, uid)
+
+    def retrieve(self, uid, properties):
+        metadata = self.retrieve_many([uid], properties)[0]
+        if metadata is None:
+            raise IOError(errno.ENOENT, 'No metadata for entry', uid)
+        return metadata
+
+    def retrieve_many(self, uids, properties):
+        # 'uid' is always fetched, to tell missing entries apart
+        if properties:
+            keys = list(set(properties) | set(['uid']))
+            key_filter = ' AND key IN (%s)' % ', '.join('?' * len(keys))
+        else:
+            keys = []
+            key_filter = ''
+
+        connection = self._get_connection()
+        found = {}
+        for start in range(0, len(uids), _SQLITE_BATCH_SIZE):
+            batch = list(uids[start:start + _SQLITE_BATCH_SIZE])
+            cursor = connection.execute(
+                'SELECT uid, key, value FROM metadata WHERE uid IN (%s)%s' %
+                (', '.join('?' * len(batch)), key_filter), batch + keys)
+            for uid, key, value in cursor:
+                # make it look like what metadatareader returns
+                value = str(value)
+                if value:
+                    value = dbus.ByteArray(value)
+                found.setdefault(uid, {})[key] = value
+
+        results = []
+        for uid in uids:
+            metadata = found.get(uid)
+            if metadata is not None and properties and \
+                    'uid' not in properties:
+                del metadata['uid']
+            results.append(metadata)
+        return results
+
+    def update(self, uid, changed, removed):
+        """See PackedBackend.update()."""
+        connection = self._get_connection()
+        with connection:
+            metadata = {}
+            cursor = connection.execute(
+                'SELECT key, value FROM metadata WHERE uid = ?', (uid, ))
+            for key, value in cursor:
+                metadata[key] = str(value)
+            if not metadata:
+                raise IOError(errno.ENOENT, 'No metadata for entry', uid)
+
+            modified = [key for key, value in changed.items()
+                        if metadata.get(key) != value]
+            modified += [key for key in removed
+                         if key in metadata and key != 'uid']
+            connection.executemany(
+                'INSERT OR REPLACE INTO metadata (uid, key, value) '
+                'VALUES (?, ?, ?)',
+                [(uid, key, sqlite3.Binary(changed[key]))
+                 for key in modified if key in changed])
+            connection.executemany(
+                'DELETE FROM metadata WHERE uid = ? AND key = ?',
+                [(uid, key) for key in modified if key not in changed])
+            if modified:
+                self._bump_version(connection, uid)
+
+        for key in modified:
+            if key in changed:
+                metadata[key] = changed[key]
+            else:
+                del metadata[key]
+        return metadata, modified
+
+    def contains(self, uid):
+        cursor = self._get_connection().execute(
+            'SELECT 1 FROM metadata WHERE uid = ? AND key = ?', (uid, 'uid'))
+        return cursor.fetchone() is not None
+
+    def delete(self, uid):
+        connection = self._get_connection()
+        with connection:
+            connection.execute('DELETE FROM metadata WHERE uid = ?', (uid, ))
+            connection.execute('DELETE FROM versions WHERE uid = ?', (uid, ))
+
+    def open_property(self, uid, key):
+        return None
+
+    def get_signature(self, uid, metadata):
+        """Return the version of an entry, as a list like
+        PackedBackend.get_signature(). Raises OSError if it is gone."""
+        row = self._get_connection().execute(
+            'SELECT version FROM versions WHERE uid = ?', (uid, )).fetchone()
+        if row is None:
+            raise OSError(errno.ENOENT, 'No metadata for entry', uid)
+        return [row[0]]
+
+    def get_syscall_counts(self):
+        # SQLite does its own I/O
+        return {}
+
+    def destroy(self):
+        """Remove the metadata of all entries."""
+        connection = getattr(self._thread_local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._thread_local.connection = None
+        for suffix in ['', '-wal', '-shm']:
+            if os.path.exists(self._path + suffix):
+                os.remove(self._path + suffix)
+
+
+BACKENDS = {
+    PackedBackend.name: PackedBackend,
+    SqliteBackend.name: SqliteBackend,
+}
+
+
+class MetadataStore(object):
+    """Store the metadata of entries, caching what was read.
+
+    The backend (see BACKENDS) defaults to the one the datastore uses.
+    Cached results are validated against the backend before being used,
+    so changes made behind our back are picked up.
+    """
+
+    def __init__(self, backend=None, cache_entries=CACHE_MAX_ENTRIES,
+                 cache_bytes=CACHE_MAX_BYTES):
+        if backend is None:
+            backend = layoutmanager.get_instance().get_metadata_backend()
+        self._backend = BACKENDS[backend]()
+        self._cache_max_entries = cache_entries
+        self._cache_max_bytes = cache_bytes
+        # (uid, properties) -> (signature, metadata, size)
+        self._cache = collections.OrderedDict()
+        self._cache_keys = {}
+        self._cache_bytes = 0
+        self._cache_lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._stale = 0
+        # bumped by every write, so that results read concurrently with
+        # one do not get cached
+        self._generation = 0
+
+    def store(self, uid, metadata):
+        metadata['uid'] = uid
+        self.store_many([(uid, metadata)])
+
+    def store_many(self, entries):
+        """Store the metadata of several (uid, metadata) entries at once.
+        """
+        layout_manager = layoutmanager.get_instance()
+        normalized = []
+        for uid, metadata in entries:
+            self._invalidate(uid)
+            entry_path = layout_manager.get_entry_path(uid)
+            if not os.path.exists(entry_path):
+                os.makedirs(entry_path)
+            normalized.append((uid, _normalize(uid, metadata)))
+        self._backend.store_many(normalized)
+
+    def set_property(self, uid, key, value):
+        self._invalidate(uid)
+        self._backend.set_property(uid, key, _to_str(value))
+        return False
 
     def retrieve(self, uid, properties=None):
-        metadata_path = layoutmanager.get_instance().get_metadata_path(uid)
-        return metadatareader.retrieve(metadata_path, properties)
+        metadata = self._get_cached(uid, properties)
+        if metadata is not None:
+            return metadata
+
+        generation = self._generation
+        before = self._get_signature_before(uid)
+        metadata = self._backend.retrieve(uid, properties)
+        self._add_cached(uid, properties, metadata, generation, before)
+        return dict(metadata)
+
+    def retrieve_many(self, uids, properties=None):
+        """Like retrieve() for a list of entries, returning a list of
+        dictionaries. Entries that do not exist (anymore) give None."""
+        results = [self._get_cached(uid, properties) for uid in uids]
+        missing = [uid for uid, metadata in zip(uids, results)
+                   if metadata is None]
+        if not missing:
+            return results
+
+        generation = self._generation
+        before = dict((uid, self._get_signature_before(uid))
+                      for uid in missing)
+        retrieved = iter(self._backend.retrieve_many(missing, properties))
+        for position, uid in enumerate(uids):
+            if results[position] is not None:
+                continue
+            metadata = retrieved.next()
+            if metadata is not None:
+                self._add_cached(uid, properties, metadata, generation,
+                                 before[uid])
+                metadata = dict(metadata)
+            results[position] = metadata
+        return results
+
+    def update(self, uid, changed, removed):
+        """Set the properties in changed and remove those listed in removed,
+        leaving the others alone.
+
+        Returns the resulting metadata (not necessarily including the
+        properties kept in files of their own) and the names of the
+        properties that actually changed.
+        """
+        self._invalidate(uid)
+        changed = dict((_normalize_key(key), _to_str(value))
+                       for key, value in changed.items())
+        changed.pop('uid', None)
+        removed = [_normalize_key(key) for key in removed
+                   if _normalize_key(key) not in changed]
+        return self._backend.update(uid, changed, removed)
+
+    def contains(self, uid):
+        return self._backend.contains(uid)
 
     def delete(self, uid):
-        metadata_path = layoutmanager.get_instance().get_metadata_path(uid)
-        for key in os.listdir(metadata_path):
-            os.remove(os.path.join(metadata_path, key))
-        os.rmdir(metadata_path)
+        self._invalidate(uid)
+        self._backend.delete(uid)
+
+    def destroy(self):
+        """Remove the metadata of all entries."""
+        with self._cache_lock:
+            self._cache.clear()
+            self._cache_keys.clear()
+            self._cache_bytes = 0
+        self._backend.destroy()
+
+    def open_property(self, uid, key):
+        """Return a file object to read the value of a property from, or
+        None if the entry does not have it.
+
+        Values stored in a file of their own are not copied.
+        """
+        blob = self._backend.open_property(uid, key)
+        if blob is not None:
+            return blob
+
+        value = self.get_property(uid, key)
+        if value is None:
+            return None
+        blob = tempfile.TemporaryFile()
+        blob.write(value)
+        blob.seek(0)
+        return blob
 
     def get_property(self, uid, key):
-        metadata_path = layoutmanager.get_instance().get_metadata_path(uid)
-        property_path = os.path.join(metadata_path, key)
-        if os.path.exists(property_path):
-            return open(property_path, 'r').read()
-        else:
+        try:
+            return self.retrieve(uid, [key]).get(key)
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+
+    def _get_cache_key(self, uid, properties):
+        if properties:
+            return uid, tuple(sorted(properties))
+        return uid, ()
+
+    def _get_cached(self, uid, properties):
+        """Return a copy of the cached result, or None."""
+        key = self._get_cache_key(uid, properties)
+        with self._cache_lock:
+            item = self._cache.pop(key, None)
+            if item is None:
+                self._misses += 1
+                return None
+            self._cache[key] = item
+
+        signature, metadata, size = item
+        try:
+            valid = self._backend.get_signature(uid, metadata) == signature
+        except OSError:
+            valid = False
+        if not valid:
+            with self._cache_lock:
+                self._stale += 1
+                self._misses += 1
+                self._remove_cached(key)
             return None
 
-    def set_property(self, uid, key, value):
-        self._set_property(uid, key, value)
+        with self._cache_lock:
+            self._hits += 1
+        return dict(metadata)
+
+    def _get_signature_before(self, uid):
+        """Return the signature of an entry before reading it, or None."""
+        try:
+            return self._backend.get_signature(uid, {})
+        except OSError:
+            return None
+
+    def _add_cached(self, uid, properties, metadata, generation, before):
+        """Cache metadata unless it was written while being read."""
+        size = _get_size(metadata)
+        if size > self._cache_max_bytes or before is None:
+            return
+        try:
+            signature = self._backend.get_signature(uid, metadata)
+        except OSError:
+            return
+        if signature[:1] != before[:1]:
+            # changed behind our back
+            return
+
+        key = self._get_cache_key(uid, properties)
+        with self._cache_lock:
+            if self._generation != generation:
+                return
+            self._remove_cached(key)
+            self._cache[key] = signature, metadata, size
+            self._cache_keys.setdefault(uid, set()).add(key)
+            self._cache_bytes += size
+            while len(self._cache) > self._cache_max_entries or \
+                    self._cache_bytes > self._cache_max_bytes:
+                self._remove_cached(iter(self._cache).next())
+
+    def _remove_cached(self, key):
+        # the caller must hold _cache_lock
+        item = self._cache.pop(key, None)
+        if item is None:
+            return
+        self._cache_bytes -= item[2]
+        keys = self._cache_keys[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._cache_keys[key[0]]
+
+    def _invalidate(self, uid):
+        with self._cache_lock:
+            self._generation += 1
+            for key in list(self._cache_keys.get(uid, [])):
+                self._remove_cached(key)
+
+    def get_syscall_counts(self):
+        """Return the number of system calls made to write metadata, by
+        kind."""
+        return self._backend.get_syscall_counts()
+
+    def get_cache_stats(self):
+        """Return hit/miss counters and the size of the retrieve() cache.
+        """
+        with self._cache_lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'stale': self._stale,
+                'entries': len(self._cache),
+                'bytes': self._cache_bytes,
+            }
@@ -24,9 +24,14 @@ import time
 import json
 
 from carquinyol import layoutmanager
+from carquinyol import metadatareader
+from carquinyol.metadatastore import MetadataStore
 
 DATE_FORMAT = '%Y-%m-%dT%H:%M:%S'
 
+# Log progress every _n_ entries
+_PROGRESS_INTERVAL = 500
+
 
 def migrate_from_0():
     logging.info('Migrating datastore from version 0 to version 1')
@@ -100,3 +105,97 @@ def _migrate_preview(root_path, old_root_path, uid):
     metadata_path = layoutmanager.get_instance().get_metadata_path(uid)
     os.rename(os.path.join(old_root_path, 'preview', uid),
               os.path.join(metadata_path, 'preview'))
+
+
+def migrate_to_7():
+    """Pack the metadata of each entry into a single file.
+
+    Entries are converted one by one. The metadata directory is only
+    removed once the packed file is in place, so an interrupted migration
+    can simply be run again. Returns False if some entries could not be
+    converted, in which case they keep their metadata directory.
+    """
+    logging.info('Migrating datastore to version 7')
+
+    layout_manager = layoutmanager.get_instance()
+    metadata_store = MetadataStore()
+    uids = layout_manager.find_all()
+    failed = 0
+    for count, uid in enumerate(uids):
+        metadata_path = layout_manager.get_metadata_path(uid)
+        if not os.path.isdir(metadata_path):
+            continue
+
+        try:
+            metadata = metadatareader.retrieve(metadata_path, None)
+            metadata_store.store(uid, metadata)
+            shutil.rmtree(metadata_path)
+        except Exception:
+            logging.exception('Error while migrating entry %r', uid)
+            failed += 1
+
+        if count % _PROGRESS_INTERVAL == 0:
+            logging.info('Migrated %d of %d entries', count, len(uids))
+
+    if failed:
+        logging.error('Could not migrate %d entries', failed)
+        return False
+    logging.info('Migration finished')
+    return True
+
+
+def migrate_metadata_backend(backend):
+    """Move the metadata of all entries to another MetadataStore backend.
+
+    The old backend stays in use until every entry has been copied, so an
+    interrupted migration leaves a working datastore and can be run
+    again. Entries whose metadata cannot be read are left out, and the
+    metadata of the old backend is kept should there be any.
+    """
+    layout_manager = layoutmanager.get_instance()
+    old_backend = layout_manager.get_metadata_backend()
+    logging.info('Moving metadata from the %s to the %s backend',
+                 old_backend, backend)
+
+    source = MetadataStore(old_backend)
+    destination = MetadataStore(backend)
+    # leftovers of an earlier, interrupted migration
+    destination.destroy()
+
+    uids = layout_manager.find_all()
+    skipped = []
+    for start in range(0, len(uids), _PROGRESS_INTERVAL):
+        batch = uids[start:start + _PROGRESS_INTERVAL]
+        entries = [(uid, metadata) for uid, metadata
+                   in _retrieve_batch(source, batch, skipped)
+                   if metadata is not None]
+        destination.store_many(entries)
+        logging.info('Moved %d of %d entries', start + len(batch),
+                     len(uids))
+
+    layout_manager.set_metadata_backend(backend)
+    if skipped:
+        logging.warning('Could not move %d entries, keeping the metadata '
+                        'of the %s backend', len(skipped), old_backend)
+    else:
+        source.destroy()
+    logging.info('Migration finished')
+
+
+def _retrieve_batch(store, uids, skipped):
+    """Return (uid, metadata) pairs, adding unreadable entries to skipped.
+    """
+    try:
+        return zip(uids, store.retrieve_many(uids))
+    except Exception:
+        logging.exception('Could not read a batch of entries, retrying '
+                          'one by one')
+
+    results = []
+    for uid in uids:
+        try:
+            results.append((uid, store.retrieve_many([uid])[0]))
+        except Exception:
+            logging.exception('Skipping entry %r', uid)
+            skipped.append(uid)
+    return results